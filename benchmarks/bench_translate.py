@@ -0,0 +1,175 @@
+# encoding: utf-8
+"""
+Micro-benchmarks of the Pyslate translation hot path.
+
+Every benchmark runs against a JsonBackend catalog containing the tags needed by the benchmarks
+and a configurable number of additional plain tags. Results can be stored as a baseline and later compared
+with another run, e.g. to measure the impact of parser or engine changes::
+
+    python benchmarks/bench_translate.py --size 10000 --save baseline.json
+    python benchmarks/bench_translate.py --size 10000 --compare baseline.json
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from pyslate.backends.json_backend import JsonBackend
+from pyslate.cache import LRUCache
+from pyslate.config import DefaultConfig
+from pyslate.parser import PyParser, FastParser
+from pyslate.pyslate import Pyslate
+
+PARSERS = {
+    "PyParser": PyParser,
+    "FastParser": FastParser,
+}
+
+TAGS = {
+    "welcome": {
+        "en": "Welcome!",
+        "pl": "Witaj!",
+    },
+    "entity_carrot": {
+        "en": "a carrot",
+        "pl": "marchewka",
+    },
+    "entity_carrot#p": {
+        "en": "%{number} carrots",
+        "pl": "%{number} marchewek",
+    },
+    "entity_carrot#w": {
+        "pl": "%{number} marchewki",
+    },
+    "entity_carrot#u": {
+        "en": "some carrots",
+        "pl": "trochę marchewek",
+    },
+    "action_give_others": {
+        "en": "You see ${giver:char_name} give ${entity_%{item_name}#u} to ${taker:char_name}.",
+        "pl": "Widzisz, jak ${giver:char_name} daje ${entity_%{item_name}#u} ${taker:char_name}.",
+    },
+    "char_name": {
+        "en": "%{name}",
+    },
+    "being_in_shop": {
+        "en": "I was in shop",
+        "pl": "Był%{m?em|f?am} dziś w sklepie",
+    },
+    "talking_the_same": {
+        "en": "I told %{sb:m?him|f?her} it's stupid and %{sb:m?|f?s}he told me the same.",
+        "pl": "Powiedział%{me:m?em|f?am} %{sb:m?mu|f?jej}, że to głupie, a on%{sb:m?|f?a} powiedział%{sb:m?|f?a} mi to samo.",
+    },
+    "template_item": {
+        "en": "%{quality} ${entity_%{item}}",
+    },
+    "a_masterwork": {
+        "en": "a masterwork",
+        "pl": "wspaniale wykonana",
+    },
+}
+
+
+def generate_catalog(size):
+    """Returns dict of tags used by the benchmarks extended by `size` plain tags"""
+    tags = dict(TAGS)
+    for i in range(size):
+        tags["filler_{}".format(i)] = {
+            "en": "Plain tag number {}".format(i),
+            "pl": "Zwykły tag numer {}".format(i),
+        }
+    return tags
+
+
+def item_info(helper, tag_name, params):
+    quality = helper.translation("a_masterwork")
+    return helper.translation("template_item", quality=quality, item=params["item_name"])
+
+
+def create_pyslate(language, backend, parser_class, result_cache_size):
+    config = DefaultConfig()
+    config.PARSER_CLASS = parser_class
+    result_cache = LRUCache(max_size=result_cache_size) if result_cache_size else None
+    pyslate = Pyslate(language, backend=backend, config=config, result_cache=result_cache)
+    pyslate.fallbacks["pl"] = "en"
+    pyslate.register_function("item_info", item_info)
+    return pyslate
+
+
+def get_benchmarks(pyslate, size):
+    """Returns list of (name, zero-argument function) pairs"""
+    plain_tags = itertools.cycle(["filler_{}".format(i) for i in range(max(size, 1))] if size else ["welcome"])
+    groups = {"giver": {"name": "John"}, "taker": {"name": "Edd"}}
+    some_date = datetime.datetime(2016, 1, 27, 18, 13, 22)
+
+    return [
+        ("plain_tag", lambda: pyslate.t(next(plain_tags))),
+        ("plain_tag_same_key", lambda: pyslate.t("welcome")),
+        ("variant_tag", lambda: pyslate.t("entity_carrot#u")),
+        ("plural_tag", lambda: pyslate.t("entity_carrot", number=4)),
+        ("inner_tags_with_groups", lambda: pyslate.t("action_give_others", item_name="carrot", groups=groups)),
+        ("switch_field", lambda: pyslate.t("talking_the_same", me="f", sb="m")),
+        ("decorator_chain", lambda: pyslate.t("entity_carrot#u@upper@capitalize@article")),
+        ("custom_function", lambda: pyslate.t("item_info", item_name="carrot")),
+        ("localize_float", lambda: pyslate.l(1234.5678)),
+        ("localize_date", lambda: pyslate.l(some_date)),
+    ]
+
+
+def run_benchmarks(language, size, parser_class, result_cache_size, number, repeat):
+    """Returns dict mapping benchmark name to the best time of a single call in microseconds"""
+    backend = JsonBackend(json_data=generate_catalog(size))
+    pyslate = create_pyslate(language, backend, parser_class, result_cache_size)
+
+    results = {}
+    for name, function in get_benchmarks(pyslate, size):
+        function()  # warm up
+        best_time = min(timeit.repeat(function, number=number, repeat=repeat))
+        results[name] = best_time / number * 1e6
+    return results
+
+
+def print_results(results, baseline=None):
+    for name in sorted(results):
+        line = "{:<26}{:>10.2f} us".format(name, results[name])
+        if baseline and name in baseline:
+            line += "{:>10.2f} us{:>8.2f}x".format(baseline[name], baseline[name] / results[name])
+        print(line)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("--size", type=int, default=1000, help="number of additional plain tags in the catalog")
+    arg_parser.add_argument("--language", default="en", choices=["en", "pl"])
+    arg_parser.add_argument("--parser", default="PyParser", choices=sorted(PARSERS))
+    arg_parser.add_argument("--result-cache", type=int, default=0, metavar="SIZE",
+                            help="size of the result cache, disabled by default")
+    arg_parser.add_argument("--number", type=int, default=2000, help="number of calls in a single measurement")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="number of measurements, the best one is used")
+    arg_parser.add_argument("--save", metavar="FILE", help="store results as a baseline in JSON file")
+    arg_parser.add_argument("--compare", metavar="FILE", help="compare results with a baseline stored in JSON file")
+    args = arg_parser.parse_args(argv)
+
+    results = run_benchmarks(args.language, args.size, PARSERS[args.parser], args.result_cache,
+                             args.number, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({"settings": vars(args), "results": results}, baseline_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
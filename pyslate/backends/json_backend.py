@@ -1,10 +1,13 @@
 import json
+import os
 import six
 
 
 class JsonBackend(object):
     """
     JSON-based backend. It has no external dependencies.
+    When it's created from a file name, then modification time of the file is a catalog version
+    and the file is reloaded when it changes (see :obj:`get_version`).
     """
 
     def __init__(self, file_name=None, file=None, json_data=None):
@@ -17,9 +20,14 @@ class JsonBackend(object):
         :return: backend to use in Pyslate
         """
 
+        self.file_name = file_name
+        self.version = None
+        self._previous_version = None
+        self._changed_tags = set()
+
         if file_name:
-            with open(file_name, "r") as file:
-                self.tags = json.loads(file.read())
+            self.version = os.path.getmtime(file_name)
+            self.tags = self._load_file(file_name)
         elif file:
             self.tags = json.loads(file.read())
         elif json_data:
@@ -51,3 +59,55 @@ class JsonBackend(object):
                         return translation[0], translation[1]
                     return translation, None
         return None
+
+    def get_all_records(self, languages, prefix=None):
+        """
+        Returns all the records for specified languages as a dict: tag name => dict: language => (content, form)
+
+        :param languages: list of languages
+        :param prefix: if specified then only tags whose names start with prefix are returned
+        """
+        records = {}
+        for tag_name, translations in self.tags.items():
+            if prefix and not tag_name.startswith(prefix):
+                continue
+            for language in languages:
+                if language in translations:
+                    translation = translations[language]
+                    if type(translation) is list:
+                        records.setdefault(tag_name, {})[language] = translation[0], translation[1]
+                    else:
+                        records.setdefault(tag_name, {})[language] = translation, None
+        return records
+
+    def get_version(self):
+        """
+        Returns modification time of the file. If it has changed since the last check, then the file is reloaded.
+        Returns None when the backend isn't created from a file name.
+        """
+        if self.file_name is None:
+            return None
+        version = os.path.getmtime(self.file_name)
+        if version != self.version:
+            tags = self._load_file(self.file_name)
+            self._changed_tags = set(name for name in set(self.tags) | set(tags)
+                                     if self.tags.get(name) != tags.get(name))
+            self._previous_version = self.version
+            self.version = version
+            self.tags = tags
+        return version
+
+    def get_changed_tags(self, version):
+        """
+        Returns set of names of tags changed since the specified version or None if it's unknown.
+        """
+        if version == self.version:
+            return set()
+        if version == self._previous_version:
+            return set(self._changed_tags)
+        return None
+
+    @staticmethod
+    def _load_file(file_name):
+        with open(file_name, "r") as file:
+            return json.loads(file.read())
@@ -1,3 +1,7 @@
+import hashlib
+import itertools
+import re
+import weakref
 
 
 class PostgresBackend(object):
@@ -7,18 +11,43 @@ class PostgresBackend(object):
      - language (VARCHAR(8))
      - content (STRING)
      - form (VARCHAR(8))
+
+    Every lookup is a single query using an index scan, so the table should have the index:
+        CREATE UNIQUE INDEX [TABLE]_name_language_idx ON [TABLE] (name, language);
+
+    Catalog version can be stored in a separate table having a single row with column:
+     - version (BIGINT)
+    which should be incremented after every change of the tags. Names of changed tags can be recorded
+    in a table with columns:
+     - name (VARCHAR(?))
+     - version (BIGINT)
+    so caches can invalidate only these tags.
     """
 
-    def __init__(self, conn, table_name):
+    def __init__(self, conn, table_name, version_table_name=None, changes_table_name=None, prepare_statements=True):
         """
         Constructor taking a handle to psycopg2 connection object and name of the table containing translations.
         Please note the table_name is not escaped in any way, so it's your responsibility to avoid risk of SQL injection
-        :param conn: psycopg2 connection
+        Instead of a connection it's possible to specify a connection pool, e.g. psycopg2.pool.ThreadedConnectionPool
+        or any object with methods getconn() and putconn(conn, close=False). Then a connection is borrowed
+        for every query, so many threads can use the backend at the same time, and a dropped connection
+        is discarded and the query is retried on another one.
+        :param conn: psycopg2 connection or connection pool
         :param table_name: name of the table with translations, IT'S NOT SAFE AGAINST SQL INJECTION
+        :param version_table_name: name of the table with catalog version, IT'S NOT SAFE AGAINST SQL INJECTION
+        :param changes_table_name: name of the table with names of changed tags and versions of the changes,
+            IT'S NOT SAFE AGAINST SQL INJECTION
+        :param prepare_statements: if True then lookups use a server-side prepared statement, which is planned
+            only once per connection. Disable it when a connection pooler doesn't support prepared statements
         :return: backend usable in Pyslate
         """
         self.conn = conn
+        self.pool = conn if hasattr(conn, "getconn") and hasattr(conn, "putconn") else None
         self.table_name = table_name
+        self.version_table_name = version_table_name
+        self.changes_table_name = changes_table_name
+        self.prepare_statements = prepare_statements
+        self._prepared_connections = weakref.WeakKeyDictionary()
 
     def get_content(self, tag_names, languages):
         record = self.get_record(tag_names, languages)
@@ -33,12 +62,166 @@ class PostgresBackend(object):
         return None
 
     def get_record(self, tag_names, languages):
-        with self.conn.cursor() as cur:
-            for language in languages:
-                for tag_name in tag_names:
-                    query_str = "SELECT content, form FROM " + self.table_name + " WHERE name = %s AND language = %s"
-                    cur.execute(query_str, (tag_name, language))
-                    ret = cur.fetchone()
-                    if ret:
-                        return ret
+        """
+        Returns (content, form) of the first existing tag, trying all the tag names for the first language,
+        then for the next one etc. All the pairs are checked by a single query, which is a prepared statement
+        unless prepare_statements is False.
+        """
+        params = (list(languages), list(tag_names))
+        if not self.prepare_statements:
+            query_str = _GET_RECORD_QUERY.format(table=self.table_name, languages="%s", tag_names="%s")
+            ret = self._query(query_str, params, _fetch_one)
+        else:
+            ret = self._execute(lambda conn: self._execute_prepared_on(conn, params))
+        if ret:
+            return ret
+        return None
+
+    def get_all_records(self, languages, prefix=None):
+        """
+        Returns all the records for specified languages as a dict: tag name => dict: language => (content, form)
+        using a single query, see :obj:`export_records`.
+
+        :param languages: list of languages
+        :param prefix: if specified then only tags whose names start with prefix are returned
+        """
+        records = {}
+        for name, language, content, form in self.export_records(languages, prefix=prefix):
+            records.setdefault(name, {})[language] = content, form
+        return records
+
+    def export_records(self, languages, prefix=None, batch_size=1000):
+        """
+        Generator of (name, language, content, form) tuples of all the records for specified languages.
+        Rows are streamed using a server-side (named) cursor, so only batch_size rows are kept in memory at once.
+        If the connection pool is used, then the connection is borrowed until the generator is exhausted or closed.
+
+        :param languages: list of languages
+        :param prefix: if specified then only tags whose names start with prefix are returned
+        :param batch_size: number of rows fetched from the server at once
+        """
+        query_str = "SELECT name, language, content, form FROM " + self.table_name + " WHERE language = ANY(%s)"
+        params = [list(languages)]
+        if prefix:
+            query_str += " AND name LIKE %s"
+            params += [prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"]
+
+        conn = self.pool.getconn() if self.pool is not None else self.conn
+        dropped = False
+        try:
+            with conn.cursor(name="pyslate_export_{}".format(next(_cursor_ids))) as cur:
+                cur.itersize = batch_size
+                cur.execute(query_str, params)
+                for row in cur:
+                    yield row
+        except Exception:
+            dropped = bool(getattr(conn, "closed", False))
+            if not dropped:
+                conn.rollback()
+            raise
+        finally:
+            if self.pool is not None:
+                self.pool.putconn(conn, close=dropped)
+
+    def get_version(self):
+        """
+        Returns catalog version or None if version table isn't specified.
+        """
+        if self.version_table_name is None:
+            return None
+        ret = self._query("SELECT version FROM " + self.version_table_name, None, _fetch_one)
+        if ret:
+            return ret[0]
         return None
+
+    def get_changed_tags(self, version):
+        """
+        Returns set of names of tags changed since the specified version or None if it's unknown.
+        """
+        if self.changes_table_name is None or version is None:
+            return None
+        query_str = "SELECT DISTINCT name FROM " + self.changes_table_name + " WHERE version > %s"
+        return self._query(query_str, (version,), lambda cur: set(row[0] for row in cur.fetchall()))
+
+    def _query(self, query_str, params, fetch):
+        """Executes the query and returns result of fetch function called with the cursor"""
+        return self._execute(lambda conn: self._execute_on(conn, query_str, params, fetch))
+
+    def _execute(self, function):
+        """
+        Returns result of the function called with a connection.
+        Connection is borrowed from the pool for the time of the call. If it turns out to be dropped,
+        then it's discarded and the function is called once again with another connection.
+        """
+        if self.pool is None:
+            return function(self.conn)
+
+        for attempt in range(2):
+            conn = self.pool.getconn()
+            try:
+                result = function(conn)
+            except Exception:
+                dropped = bool(getattr(conn, "closed", False))
+                self.pool.putconn(conn, close=dropped)
+                if not dropped or attempt > 0:
+                    raise
+            else:
+                self.pool.putconn(conn)
+                return result
+
+    def _execute_prepared_on(self, conn, params):
+        """
+        Executes get_record statement, which is prepared once per connection. If the statement is unknown
+        to the server (e.g. the session was reset by a connection pooler), then it's prepared again.
+        """
+        query_str = _GET_RECORD_QUERY.format(table=self.table_name, languages="$1", tag_names="$2")
+        # different table names can give the same identifier (e.g. "public.tags" and "public_tags"),
+        # so the name starts with a hash of the query, which isn't cut off when a long name is truncated by the server
+        query_hash = hashlib.md5(query_str.encode("utf-8")).hexdigest()[:12]
+        statement_name = "pyslate_get_record_{}_{}".format(query_hash, _NON_IDENTIFIER_REGEX.sub("_", self.table_name))
+        for attempt in range(2):
+            if conn not in self._prepared_connections:
+                try:
+                    self._execute_on(conn, "PREPARE " + statement_name + " (text[], text[]) AS " + query_str, None,
+                                     lambda cur: None)
+                except Exception as e:
+                    if getattr(e, "pgcode", None) != _DUPLICATE_STATEMENT_CODE:  # else prepared by another instance
+                        raise
+                self._prepared_connections[conn] = True
+            try:
+                return self._execute_on(conn, "EXECUTE " + statement_name + " (%s, %s)", params, _fetch_one)
+            except Exception as e:
+                if getattr(e, "pgcode", None) != _UNKNOWN_STATEMENT_CODE or attempt > 0:
+                    raise
+                self._prepared_connections.pop(conn, None)
+
+    @staticmethod
+    def _execute_on(conn, query_str, params, fetch):
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query_str, params)
+                return fetch(cur)
+        except Exception:
+            # failed query aborts the transaction, so it must be rolled back to make the connection usable again
+            if not getattr(conn, "closed", False):
+                conn.rollback()
+            raise
+
+
+def _fetch_one(cur):
+    return cur.fetchone()
+
+
+_GET_RECORD_QUERY = (
+    "SELECT t.content, t.form FROM {table} t"
+    " JOIN unnest({languages}::text[]) WITH ORDINALITY AS l(language, priority) ON t.language = l.language"
+    " JOIN unnest({tag_names}::text[]) WITH ORDINALITY AS n(name, priority) ON t.name = n.name"
+    " ORDER BY l.priority, n.priority LIMIT 1")
+
+_NON_IDENTIFIER_REGEX = re.compile(r"\W")
+
+# SQLSTATE codes of errors "prepared statement does not exist" and "prepared statement already exists"
+_UNKNOWN_STATEMENT_CODE = "26000"
+_DUPLICATE_STATEMENT_CODE = "42P05"
+
+_cursor_ids = itertools.count()
@@ -1,3 +1,12 @@
+# encoding: utf-8
+import six
+
+
+def escape_pattern(text):
+    """Escapes characters having special meaning in glob-style patterns of Redis"""
+    for special_char in "\\*?[]":
+        text = text.replace(special_char, "\\" + special_char)
+    return text
 
 
 class RedisBackend(object):
@@ -11,6 +20,15 @@ class RedisBackend(object):
     Examples:
         pyslate_hello_world:en => {"content": "Hello world!"}
         pyslate_judy:en => {"content": "Policewoman Judy", "form": "f"}
+
+    Catalog version is an integer stored under "[PREFIX]version" key, which should be incremented
+    after every change of the tags. Changes can be recorded in a sorted set "[PREFIX]changes" as members
+    "[VERSION]:[TAGKEY]" with the new version as a score, so caches can invalidate only these tags.
+    Every version must have at least one member, a version which doesn't change any tag has member "[VERSION]:". E.g.
+        INCR pyslate_version => 8
+        ZADD pyslate_changes 8 8:judy 8:hello
+    If any version since the cached one has no members (e.g. it was bumped without recording the changes
+    or old changes were removed), then caches are cleared entirely.
     """
 
     def __init__(self, strict_redis, prefix="pyslate_"):
@@ -23,6 +41,8 @@ class RedisBackend(object):
 
         self.redis = strict_redis
         self.prefix = prefix
+        self.version_key = prefix + "version"
+        self.changes_key = prefix + "changes"
 
     def get_content(self, tag_names, languages):
         record = self.get_record(tag_names, languages)
@@ -48,8 +68,221 @@ class RedisBackend(object):
                 return [self._save_decode_bytes(r) for r in record]
         return None
 
+    def get_all_records(self, languages, prefix=None, batch_size=1000):
+        """
+        Returns all the records for specified languages as a dict: tag name => dict: language => (content, form).
+        Keys are found using SCAN command, so it doesn't block the database, and hashes are read in batches.
+
+        :param languages: list of languages
+        :param prefix: if specified then only tags whose names start with prefix are returned
+        :param batch_size: number of hashes read in a single round trip
+        """
+        languages = set(languages)
+        keys = [(tag_name, language) for tag_name, language in self._scan_keys(prefix, batch_size)
+                if language in languages]
+
+        records = {}
+        for i in range(0, len(keys), batch_size):
+            pipe = self.redis.pipeline()
+            for tag_name, language in keys[i:i + batch_size]:
+                pipe.hmget(self.prefix + tag_name + ":" + language, ["content", "form"])
+            for (tag_name, language), record in zip(keys[i:i + batch_size], pipe.execute()):
+                if record[0] is not None:
+                    records.setdefault(tag_name, {})[language] = tuple(self._save_decode_bytes(r) for r in record)
+        return records
+
+    def get_version(self):
+        """
+        Returns catalog version stored in the database or None if it's not set.
+        """
+        version = self.redis.get(self.version_key)
+        if version is None:
+            return None
+        return int(version)
+
+    def get_changed_tags(self, version):
+        """
+        Returns set of names of tags changed since the specified version or None if it's unknown.
+        Changes are known only if every version after the specified one up to the current one
+        has its members in the sorted set of changes.
+        """
+        if version is None:
+            return None
+        pipe = self.redis.pipeline()
+        pipe.get(self.version_key)
+        pipe.zrangebyscore(self.changes_key, "(" + str(version), "+inf", withscores=True)
+        current_version, changes = pipe.execute()
+
+        if current_version is None or int(current_version) < version:
+            return None
+        current_version = int(current_version)
+        changed_tags = set()
+        recorded_versions = set()
+        for member, score in changes:
+            if score > current_version:  # recorded before the version is incremented
+                continue
+            recorded_versions.add(int(score))
+            tag_name = self._save_decode_bytes(member).partition(":")[2]
+            if tag_name:
+                changed_tags.add(tag_name)
+        if len(recorded_versions) < current_version - version:
+            return None
+        return changed_tags
+
+    def _scan_keys(self, prefix, batch_size):
+        """Generator of (tag name, language) pairs of all the keys in the database whose tag name has the prefix"""
+        for key in self.redis.scan_iter(match=escape_pattern(self.prefix + (prefix or "")) + "*", count=batch_size):
+            key = self._save_decode_bytes(key)
+            tag_name, _, language = key[len(self.prefix):].rpartition(":")
+            if tag_name:
+                yield tag_name, language
+
     @staticmethod
     def _save_decode_bytes(var):
-        if var is None:
-            return None
+        if var is None or isinstance(var, six.text_type):  # client can decode responses itself
+            return var
         return var.decode("utf-8")
+
+
+class RedisTagHashBackend(RedisBackend):
+    """
+    Redis backend storing all the translations of a tag in a single hash, so finding the record considering
+    all the variants and fallback languages needs one command for every tag name instead of one command
+    for every (tag name, language) pair. Optionally the whole lookup is done by a Lua script,
+    which returns only the first existing record.
+    Requires redis-py library (https://github.com/andymccurdy/redis-py)
+
+    Key of the hash follows the pattern "[PREFIX][TAGKEY]" and hash has fields "content:[LANGUAGE]" (required)
+    and "form:[LANGUAGE]" (optional). Examples:
+        pyslate_hello_world => {"content:en": "Hello world!", "content:pl": "Witaj świecie!"}
+        pyslate_judy => {"content:en": "Policewoman Judy", "form:en": "f"}
+
+    Catalog version and changes are stored like in :obj:`RedisBackend`, but under keys "[PREFIX]:version"
+    and "[PREFIX]:changes". Data stored in :obj:`RedisBackend` layout can be converted using
+    :obj:`migrate_to_tag_hashes`.
+    """
+
+    def __init__(self, strict_redis, prefix="pyslate_", use_script=False):
+        """
+        :param strict_redis: handle to strict redis database
+        :param prefix: prefix used in keys for all tag hashes
+        :param use_script: if True then records are found by a Lua script run on the server
+        :return: backend to use in Pyslate
+        """
+        super(RedisTagHashBackend, self).__init__(strict_redis, prefix)
+        self.version_key = prefix + ":version"
+        self.changes_key = prefix + ":changes"
+        self.use_script = use_script
+        self._get_record_script = strict_redis.register_script(_GET_RECORD_SCRIPT) if use_script else None
+
+    def get_record(self, tag_names, languages):
+        keys = [self.prefix + tag_name for tag_name in tag_names]
+        if self.use_script:
+            record = self._get_record_script(keys=keys, args=list(languages))
+            if not record:
+                return None
+            return [self._save_decode_bytes(r) for r in record]
+
+        fields = []
+        for language in languages:
+            fields += ["content:" + language, "form:" + language]
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.hmget(key, fields)
+        records_by_tag = pipe.execute()
+
+        for i in range(len(languages)):
+            for record in records_by_tag:
+                if record[2 * i] is not None:
+                    return [self._save_decode_bytes(r) for r in record[2 * i:2 * i + 2]]
+        return None
+
+    def get_all_records(self, languages, prefix=None, batch_size=1000):
+        """
+        Returns all the records for specified languages as a dict: tag name => dict: language => (content, form).
+        Keys are found using SCAN command, so it doesn't block the database, and hashes are read in batches.
+
+        :param languages: list of languages
+        :param prefix: if specified then only tags whose names start with prefix are returned
+        :param batch_size: number of hashes read in a single round trip
+        """
+        tag_names = []
+        for key in self.redis.scan_iter(match=escape_pattern(self.prefix + (prefix or "")) + "*", count=batch_size):
+            tag_name = self._save_decode_bytes(key)[len(self.prefix):]
+            if ":" not in tag_name:  # skip version keys and keys of other layouts
+                tag_names.append(tag_name)
+
+        records = {}
+        for i in range(0, len(tag_names), batch_size):
+            pipe = self.redis.pipeline()
+            for tag_name in tag_names[i:i + batch_size]:
+                pipe.hgetall(self.prefix + tag_name)
+            # keys of other types (e.g. version of RedisBackend with the same prefix) give errors, which are skipped
+            for tag_name, tag_hash in zip(tag_names[i:i + batch_size], pipe.execute(raise_on_error=False)):
+                if not isinstance(tag_hash, dict):
+                    continue
+                tag_hash = dict((self._save_decode_bytes(field), self._save_decode_bytes(value))
+                                for field, value in tag_hash.items())
+                for language in languages:
+                    if "content:" + language in tag_hash:
+                        records.setdefault(tag_name, {})[language] = (tag_hash["content:" + language],
+                                                                      tag_hash.get("form:" + language))
+        return records
+
+
+def migrate_to_tag_hashes(strict_redis, prefix="pyslate_", target_prefix=None, remove_old_keys=False,
+                          batch_size=1000):
+    """
+    Copies all the tags stored in :obj:`RedisBackend` layout to :obj:`RedisTagHashBackend` layout,
+    together with the catalog version and the changes. Both layouts can be kept in the same database with the same prefix.
+
+    :param strict_redis: handle to strict redis database
+    :param prefix: prefix of keys of :obj:`RedisBackend`
+    :param target_prefix: prefix of keys of :obj:`RedisTagHashBackend`. By default it's the same as prefix
+    :param remove_old_keys: if True then copied keys are removed
+    :param batch_size: number of keys copied in a single round trip
+    :return: number of copied (tag, language) records
+    """
+    source = RedisBackend(strict_redis, prefix)
+    target = RedisTagHashBackend(strict_redis, prefix if target_prefix is None else target_prefix)
+
+    keys = list(source._scan_keys(None, batch_size))
+    copied_count = 0
+    for i in range(0, len(keys), batch_size):
+        pipe = strict_redis.pipeline()
+        for tag_name, language in keys[i:i + batch_size]:
+            pipe.hmget(prefix + tag_name + ":" + language, ["content", "form"])
+        records = pipe.execute()
+
+        pipe = strict_redis.pipeline()
+        for (tag_name, language), (content, form) in zip(keys[i:i + batch_size], records):
+            if content is None:
+                continue
+            pipe.hset(target.prefix + tag_name, "content:" + language, content)
+            if form is not None:
+                pipe.hset(target.prefix + tag_name, "form:" + language, form)
+            if remove_old_keys:
+                pipe.delete(prefix + tag_name + ":" + language)
+            copied_count += 1
+        pipe.execute()
+
+    version = strict_redis.get(source.version_key)
+    if version is not None:
+        strict_redis.set(target.version_key, version)
+    if strict_redis.exists(source.changes_key):
+        strict_redis.zunionstore(target.changes_key, [source.changes_key])
+    return copied_count
+
+
+# returns [content, form] of the first existing record, KEYS are tag hashes and ARGV are languages
+_GET_RECORD_SCRIPT = """
+for i = 1, #ARGV do
+    for j = 1, #KEYS do
+        local record = redis.call("HMGET", KEYS[j], "content:" .. ARGV[i], "form:" .. ARGV[i])
+        if record[1] then
+            return record
+        end
+    end
+end
+return nil
+"""
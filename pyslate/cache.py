@@ -1,6 +1,20 @@
+import json
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import six
+
+from .backends.redis_backend import escape_pattern
 
 
 class SimpleMemoryCache(object):
+    """
+    Cache of tag records (content and grammatical form) which is never limited in size.
+    For long-running processes it's better to use :obj:`BoundedMemoryCache`.
+    """
 
     def __init__(self):
         self.cache = {}
@@ -14,9 +28,620 @@ class SimpleMemoryCache(object):
         return None
 
     def remove(self, tag_name):
-        for tag_language_tuple in self.cache:
+        for tag_language_tuple in list(self.cache):
             if tag_language_tuple[0] == tag_name:
                 self.cache.pop(tag_language_tuple, None)
 
     def clear(self):
-        self.cache.clear()
\ No newline at end of file
+        self.cache.clear()
+
+
+class BoundedMemoryCache(object):
+    """
+    Thread-safe cache of tag records (content and grammatical form) with the same API as :obj:`SimpleMemoryCache`.
+    It's limited by the number of entries and optionally by the total size of the cached strings.
+    When it's full, then the least recently used (policy "lru") or the least frequently used (policy "lfu")
+    entry is evicted. All the operations except clearing are O(1).
+    Records of missing tags (whose content is None) expire after missing_ttl, which should be shorter than ttl,
+    so tags added to the backend are soon available.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, policy="lru", ttl=None, missing_ttl=60, timer=time.time):
+        """
+        :param max_entries: maximal number of cached (tag, language) records.
+            If it's not positive, then nothing is stored
+        :param max_bytes: maximal total size of cached records in bytes. If None then the size is not limited
+        :param policy: eviction policy, "lru" or "lfu"
+        :param ttl: number of seconds after which the record expires. If None then records never expire
+        :param missing_ttl: number of seconds after which the record of a missing tag expires.
+            If None then they never expire
+        :param timer: function returning current time in seconds
+        """
+        if policy not in _EVICTION_POLICIES:
+            raise ValueError("unknown eviction policy '{}', it must be one of {}".format(
+                policy, sorted(_EVICTION_POLICIES)))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        """Total size of the cached records in bytes"""
+        self._records = {}  # (tag_name, language) -> (content, form, size_in_bytes, expiration_time)
+        self._languages_by_tag = {}
+        self._tags_by_language = {}
+        self._policy = _EVICTION_POLICIES[policy]()
+        self._lock = threading.Lock()
+
+    def save(self, tag_name, language, content, form):
+        key = (tag_name, language)
+        size = sys.getsizeof(tag_name) + sys.getsizeof(content) + (sys.getsizeof(form) if form is not None else 0)
+        ttl = self.ttl if content is not None else self.missing_ttl
+        expires_at = self.timer() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._records:  # replaced record is treated as a new one
+                self._policy.remove(key)
+                self._remove_entry(key)
+            # old record is removed anyway, it's outdated
+            if self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+                return
+
+            # make room before adding, otherwise the new entry could be the one to evict
+            while self._records and (len(self._records) >= self.max_entries or (
+                    self.max_bytes is not None and self.size_bytes + size > self.max_bytes)):
+                self._remove_entry(self._policy.pop_victim())
+                self.evictions += 1
+
+            self._policy.add(key)
+            self._languages_by_tag.setdefault(tag_name, set()).add(language)
+            self._tags_by_language.setdefault(language, set()).add(tag_name)
+            self._records[key] = (content, form, size, expires_at)
+            self.size_bytes += size
+
+    def load(self, tag_name, language):
+        key = (tag_name, language)
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record[3] is not None and record[3] <= self.timer():
+                self._policy.remove(key)
+                self._remove_entry(key)
+                record = None
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._policy.touch(key)
+            return record[0], record[1]
+
+    def remove(self, tag_name):
+        with self._lock:
+            for language in list(self._languages_by_tag.get(tag_name, ())):
+                self._policy.remove((tag_name, language))
+                self._remove_entry((tag_name, language))
+
+    def clear(self, language=None):
+        """
+        Removes all the entries or only the entries for the specified language.
+        """
+        with self._lock:
+            if language is None:
+                self._records.clear()
+                self._languages_by_tag.clear()
+                self._tags_by_language.clear()
+                self._policy = type(self._policy)()
+                self.size_bytes = 0
+                return
+            for tag_name in list(self._tags_by_language.get(language, ())):
+                self._policy.remove((tag_name, language))
+                self._remove_entry((tag_name, language))
+
+    def _remove_entry(self, key):
+        """Removes entry from records and the indexes, but not from the eviction policy"""
+        tag_name, language = key
+        self.size_bytes -= self._records.pop(key)[2]
+
+        languages = self._languages_by_tag[tag_name]
+        languages.discard(language)
+        if not languages:
+            del self._languages_by_tag[tag_name]
+
+        tags = self._tags_by_language[language]
+        tags.discard(tag_name)
+        if not tags:
+            del self._tags_by_language[language]
+
+    def __len__(self):
+        return len(self._records)
+
+
+class TwoTierCache(object):
+    """
+    Cache of tag records with the same API as :obj:`SimpleMemoryCache`, which is shared by many processes.
+    It consists of a small in-process cache (L1) and a Redis database (L2).
+    Requires redis-py library (https://github.com/andymccurdy/redis-py), it can be the same StrictRedis instance
+    which is used by :obj:`RedisBackend <pyslate.backends.redis_backend.RedisBackend>`.
+
+    Records are looked up in L1 first, then in L2. Record found in L2 is written back to L1.
+    When L2 is unreachable, then the cache silently works as L1 alone and L2 isn't tried again
+    for retry_interval seconds, so lookups don't wait for connection timeouts one after another.
+    Records of missing tags are kept only in L1, because hashes in L2 can't expire field by field.
+
+    L2 contains hashes whose key follows the pattern "[PREFIX][TAGKEY]", fields are languages
+    and values are JSON arrays [content, form]. E.g.
+        pyslate_cache_judy => {"en": '["Policewoman Judy","f"]'}
+    """
+
+    def __init__(self, strict_redis, l1_cache=None, prefix="pyslate_cache_", ttl=None, errors=None,
+                 retry_interval=5, timer=time.time):
+        """
+        :param strict_redis: handle to strict redis database
+        :param l1_cache: in-process cache, by default :obj:`BoundedMemoryCache` with 1000 entries
+        :param prefix: prefix used in keys of all hashes in L2
+        :param ttl: number of seconds after which the hash of a tag in L2 expires. If None then it never expires
+        :param errors: tuple of exceptions meaning that L2 is unreachable.
+            By default connection errors and timeouts of redis-py and socket errors
+        :param retry_interval: number of seconds after an error during which L2 isn't used
+        :param timer: function returning current time in seconds
+        """
+        self.redis = strict_redis
+        self.l1_cache = l1_cache if l1_cache is not None else BoundedMemoryCache(max_entries=1000)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.errors = errors if errors is not None else _get_redis_connection_errors()
+        self.retry_interval = retry_interval
+        self.timer = timer
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.l2_errors = 0
+        """Number of failed L2 operations"""
+        self._l2_retry_at = None  # time after which L2 is used again, None if it's available
+
+    def save(self, tag_name, language, content, form):
+        self.l1_cache.save(tag_name, language, content, form)
+        if content is None or not self._is_l2_available():
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hset(self.prefix + tag_name, language, json.dumps([content, form], separators=(",", ":")))
+            if self.ttl is not None:
+                pipe.expire(self.prefix + tag_name, self.ttl)
+            pipe.execute()
+        except self.errors:
+            self._l2_failed()
+
+    def load(self, tag_name, language):
+        record = self.l1_cache.load(tag_name, language)
+        if record is not None or not self._is_l2_available():
+            return record
+
+        try:
+            value = self.redis.hget(self.prefix + tag_name, language)
+        except self.errors:
+            self._l2_failed()
+            return None
+        if value is None:
+            self.l2_misses += 1
+            return None
+        self.l2_hits += 1
+
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        content, form = json.loads(value)
+        self.l1_cache.save(tag_name, language, content, form)
+        return content, form
+
+    def remove(self, tag_name):
+        self.l1_cache.remove(tag_name)
+        if not self._is_l2_available():
+            return
+        try:
+            self.redis.delete(self.prefix + tag_name)
+        except self.errors:
+            self._l2_failed()
+
+    def clear(self):
+        """
+        Removes all the entries from L1 and all the hashes with the prefix from L2.
+        """
+        self.l1_cache.clear()
+        if not self._is_l2_available():
+            return
+        try:
+            keys = list(self.redis.scan_iter(match=escape_pattern(self.prefix) + "*"))
+            if keys:
+                self.redis.delete(*keys)
+        except self.errors:
+            self._l2_failed()
+
+    def _is_l2_available(self):
+        retry_at = self._l2_retry_at
+        return retry_at is None or self.timer() >= retry_at
+
+    def _l2_failed(self):
+        self.l2_errors += 1
+        self._l2_retry_at = self.timer() + self.retry_interval
+
+    def check_version(self):
+        """Returns generation of L1 (see :obj:`VersionedCache.check_version`) or None if L1 isn't versioned"""
+        return _check_version(self.l1_cache)
+
+
+def _check_version(cache):
+    """Returns generation of the cache if it checks versions of the catalog (like :obj:`VersionedCache`), else None"""
+    check_version = getattr(cache, "check_version", None)
+    if check_version is None:
+        return None
+    return check_version()
+
+
+class VersionedCache(object):
+    """
+    Wrapper of a cache of tag records with the same API as :obj:`SimpleMemoryCache`, which invalidates
+    the records when a catalog version of the backend changes. The version is checked at most every
+    check_interval seconds using ``get_version()`` method of the backend. If the backend has also
+    ``get_changed_tags(version)`` method returning names of the changed tags, then only these tags
+    (together with their variants) are removed, otherwise the whole cache is cleared.
+    """
+
+    def __init__(self, cache, backend, check_interval=5, timer=time.time, max_tracked_tags=10000):
+        """
+        :param cache: wrapped cache, e.g. :obj:`BoundedMemoryCache`
+        :param backend: backend having get_version method
+        :param check_interval: minimal number of seconds between checks of the catalog version
+        :param timer: function returning current time in seconds
+        :param max_tracked_tags: maximal number of base tags whose cached variants are remembered. When it's exceeded,
+            then the records of the tag saved least recently are removed from the wrapped cache
+        """
+        self.cache = cache
+        self.backend = backend
+        self.check_interval = check_interval
+        self.timer = timer
+        self.max_tracked_tags = max_tracked_tags
+        self.generation = 0
+        """Number of invalidations, it's changed every time cached records are removed because of a new version"""
+        self.catalog_version = backend.get_version()
+        self._next_check = self.timer() + check_interval
+        self._variants_by_tag = OrderedDict()  # base tag name => set of saved tag names
+        self._lock = threading.Lock()
+
+    def check_version(self):
+        """
+        Checks catalog version if check_interval has passed since the last check and invalidates the records
+        if it has changed.
+
+        :return: current generation of the cache
+        """
+        if self.timer() < self._next_check:
+            return self.generation
+        with self._lock:
+            if self.timer() < self._next_check:  # checked by another thread in the meantime
+                return self.generation
+            version = self.backend.get_version()
+            if version != self.catalog_version:
+                self._invalidate(self.catalog_version)
+                self.catalog_version = version
+                self.generation += 1
+            self._next_check = self.timer() + self.check_interval
+            return self.generation
+
+    def save(self, tag_name, language, content, form):
+        base_name = tag_name.partition("#")[0]
+        with self._lock:
+            variants = self._variants_by_tag.pop(base_name, None) or set()
+            variants.add(tag_name)
+            if self._variants_by_tag and len(self._variants_by_tag) >= self.max_tracked_tags:
+                # records which are no longer tracked couldn't be invalidated, so they are removed
+                for forgotten_tag_name in self._variants_by_tag.popitem(last=False)[1]:
+                    self.cache.remove(forgotten_tag_name)
+            self._variants_by_tag[base_name] = variants  # reinserted as the most recently saved one
+        self.cache.save(tag_name, language, content, form)
+
+    def load(self, tag_name, language):
+        self.check_version()
+        return self.cache.load(tag_name, language)
+
+    def remove(self, tag_name):
+        self.cache.remove(tag_name)
+
+    def clear(self):
+        with self._lock:
+            self._variants_by_tag.clear()
+        self.cache.clear()
+
+    def _invalidate(self, version):
+        """Removes records changed since the version, it's called with the lock held"""
+        get_changed_tags = getattr(self.backend, "get_changed_tags", None)
+        changed_tags = get_changed_tags(version) if get_changed_tags else None
+        if changed_tags is None:
+            self._variants_by_tag.clear()
+            self.cache.clear()
+            return
+        for tag_name in changed_tags:
+            # record of a variant can contain value of the base tag, so all the variants are removed
+            base_name = tag_name.partition("#")[0]
+            for cached_tag_name in list(self._variants_by_tag.pop(base_name, ())):
+                self.cache.remove(cached_tag_name)
+            self.cache.remove(tag_name)
+
+
+class RevalidatingCache(object):
+    """
+    Wrapper of a cache of tag records with the same API as :obj:`SimpleMemoryCache`, which serves stale records
+    while they are refreshed in background. Record older than soft_ttl is still returned by :obj:`load_with_refresh`,
+    but at the same time it's fetched again from the backend in another thread. Record older than hard_ttl
+    isn't returned at all, so it's fetched synchronously. Wrapped cache shouldn't expire records before hard_ttl.
+    Age of records found in the wrapped cache, but not saved by this wrapper (e.g. saved in a shared cache
+    by another process), is unknown, so they are returned and refreshed like the stale ones.
+    """
+
+    def __init__(self, cache, soft_ttl=60, hard_ttl=3600, executor=None, timer=time.time, max_tracked_tags=10000):
+        """
+        :param cache: wrapped cache, e.g. :obj:`BoundedMemoryCache`
+        :param soft_ttl: number of seconds after which the record is refreshed in background
+        :param hard_ttl: number of seconds after which the record is no longer returned
+        :param executor: object whose submit(function) method runs function in background,
+            e.g. concurrent.futures.ThreadPoolExecutor. By default a new daemon thread is started for every refresh
+        :param timer: function returning current time in seconds
+        :param max_tracked_tags: maximal number of tags whose time of saving is remembered. When it's exceeded,
+            then the tag saved least recently is forgotten and its records are considered stale
+        """
+        self.cache = cache
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.executor = executor
+        self.timer = timer
+        self.max_tracked_tags = max_tracked_tags
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._saved_at = OrderedDict()  # tag_name => dict: language => time of saving the record
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def save(self, tag_name, language, content, form):
+        with self._lock:
+            saved_at = self._saved_at.pop(tag_name, {})
+            saved_at[language] = self.timer()
+            if self._saved_at and len(self._saved_at) >= self.max_tracked_tags:
+                self._saved_at.popitem(last=False)
+            self._saved_at[tag_name] = saved_at  # reinserted as the most recently saved one
+        self.cache.save(tag_name, language, content, form)
+
+    def load(self, tag_name, language):
+        return self.load_with_refresh(tag_name, language, None)
+
+    def load_with_refresh(self, tag_name, language, refresh):
+        """
+        Returns the record like :obj:`load`. If it's older than soft_ttl, then refresh function returning
+        a new record (content, form) is run in background and its result is saved in the cache.
+        """
+        with self._lock:
+            saved_at = self._saved_at.get(tag_name, {}).get(language)
+        age = self.timer() - saved_at if saved_at is not None else None
+        if age is not None and age >= self.hard_ttl:
+            return None
+        record = self.cache.load(tag_name, language)
+        if record is not None and (age is None or age >= self.soft_ttl) and refresh is not None:
+            self._start_refresh(tag_name, language, refresh)
+        return record
+
+    def remove(self, tag_name):
+        with self._lock:
+            self._saved_at.pop(tag_name, None)
+        self.cache.remove(tag_name)
+
+    def clear(self):
+        with self._lock:
+            self._saved_at.clear()
+        self.cache.clear()
+
+    def check_version(self):
+        """Returns generation of the wrapped cache (see :obj:`VersionedCache.check_version`) or None if there is none"""
+        return _check_version(self.cache)
+
+    def _start_refresh(self, tag_name, language, refresh):
+        with self._lock:
+            if (tag_name, language) in self._refreshing:  # only one refresh of the record at a time
+                return
+            self._refreshing.add((tag_name, language))
+
+        def refresh_record():
+            try:
+                content, form = refresh()
+                if content is not None:
+                    self.save(tag_name, language, content, form)
+                else:  # tag was removed from the backend
+                    self.remove(tag_name)
+                self.refreshes += 1
+            except Exception:
+                self.refresh_errors += 1  # stale record is served until the next try or hard_ttl
+            finally:
+                with self._lock:
+                    self._refreshing.discard((tag_name, language))
+
+        if self.executor is not None:
+            self.executor.submit(refresh_record)
+        else:
+            thread = threading.Thread(target=refresh_record)
+            thread.daemon = True
+            thread.start()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key, so the function is run only once at a time for the key
+    and all the callers waiting for it get its result (or exception).
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        """Number of calls which waited for the result of another call instead of running the function"""
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """
+        Returns result of the function. If another thread is already running it for the same key,
+        then waits for its result instead.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                six.reraise(*call.exc_info)
+            return call.result
+
+        try:
+            call.result = function()
+            return call.result
+        except BaseException:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call(object):
+
+    __slots__ = ("done", "result", "exc_info")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+def _get_redis_connection_errors():
+    try:
+        from redis.exceptions import ConnectionError, TimeoutError
+    except ImportError:
+        return socket.error,
+    return ConnectionError, TimeoutError, socket.error
+
+
+class _LRUPolicy(object):
+
+    def __init__(self):
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        self._keys[key] = None
+
+    def touch(self, key):
+        del self._keys[key]
+        self._keys[key] = None
+
+    def remove(self, key):
+        del self._keys[key]
+
+    def pop_victim(self):
+        return self._keys.popitem(last=False)[0]
+
+
+class _LFUPolicy(object):
+    """
+    Keys are grouped in buckets by the number of uses, so each operation is O(1).
+    In a bucket the least recently used key is evicted first.
+    """
+
+    def __init__(self):
+        self._frequencies = {}
+        self._buckets = {}
+        self._min_frequency = 0
+
+    def add(self, key):
+        self._frequencies[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_frequency = 1
+
+    def touch(self, key):
+        frequency = self._frequencies[key]
+        self._remove_from_bucket(key, frequency)
+        if self._min_frequency == frequency and frequency not in self._buckets:
+            self._min_frequency = frequency + 1
+        self._frequencies[key] = frequency + 1
+        self._buckets.setdefault(frequency + 1, OrderedDict())[key] = None
+
+    def remove(self, key):
+        self._remove_from_bucket(key, self._frequencies.pop(key))
+
+    def pop_victim(self):
+        if self._min_frequency not in self._buckets:  # minimum is unknown after removal of keys
+            self._min_frequency = min(self._buckets)
+        key = next(iter(self._buckets[self._min_frequency]))
+        self.remove(key)
+        return key
+
+    def _remove_from_bucket(self, key, frequency):
+        bucket = self._buckets[frequency]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[frequency]
+
+
+_EVICTION_POLICIES = {
+    "lru": _LRUPolicy,
+    "lfu": _LFUPolicy,
+}
+
+
+class LRUCache(object):
+    """
+    Thread-safe key-value cache with a limited number of entries. When it's full, then the least recently used
+    entry is evicted. Entries can also expire after ttl seconds.
+    It's used e.g. as a cache of results of :obj:`Pyslate.translate <pyslate.pyslate.Pyslate.translate>`.
+    """
+
+    def __init__(self, max_size=1000, ttl=None, timer=time.time):
+        """
+        :param max_size: maximal number of entries. If it's not positive, then nothing is stored
+        :param ttl: number of seconds after which the entry expires. If None then entries never expire
+        :param timer: function returning current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (entry[1] is not None and entry[1] <= self.timer()):
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries[key] = entry  # reinserted as the most recently used one
+            return entry[0]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires_at = self.timer() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            if len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (value, expires_at)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -19,6 +19,27 @@ from .parser import PyParser
 # This config file contains default configuration and is part of the library, so changing anything there
 # may make it hard to upgrade. Override config values as specified in documentation string of DefaultConfig.
 
+
+def _capitalize(text):
+    return text.capitalize()
+
+
+def _upper(text):
+    return text.upper()
+
+
+def _lower(text):
+    return text.lower()
+
+
+def _article(name):
+    return ("an " if name[0].lower() in "aeiou" else "a ") + name
+
+
+BUILTIN_DETERMINISTIC_DECORATORS = frozenset([_capitalize, _upper, _lower, _article])
+"""Built-in decorators whose result depends only on the text, so Pyslate registers them as deterministic"""
+
+
 class DefaultConfig(object):
     """
     Default values for configuration options of Pyslate.
@@ -86,15 +107,57 @@ class DefaultConfig(object):
         Default: ``True``
         """
 
+        self.CACHE_MISSING_TAGS = False
+        """
+        Specifies if tags which are missing in the backend (for the main language and all its fallbacks)
+        should be remembered in the cache, so the backend isn't asked for them again.
+        They are saved as records whose content is None, so the cache must accept such records.
+        It should be enabled only with a cache which expires them, e.g.
+        :obj:`BoundedMemoryCache <pyslate.cache.BoundedMemoryCache>` keeps them for a shorter time than other records
+        (see its ``missing_ttl``). :obj:`SimpleMemoryCache <pyslate.cache.SimpleMemoryCache>` would keep them
+        until it's cleared, so tags added to the backend later would still be missing.
+
+        Default: ``False``
+        """
+
+        self.COALESCE_BACKEND_CALLS = True
+        """
+        Specifies if concurrent lookups of the same tag (for the same languages) in the same backend should be
+        coalesced, so only one thread calls the backend and others wait for its result.
+        It prevents many identical backend calls when a popular tag is missing in the cache.
+
+        Default: ``True``
+        """
+
         self.PARSER_CLASS = PyParser
         """
         Contains class used as a parser of tag value to get AST with plaintext and variable, inner tag and switch fields
         It's used if you don't specify own parser instance in Pyslate constructor's keyword-argument.
         Default implementation is done using PLY parser generator.
+        :obj:`FastParser <pyslate.parser.FastParser>` is a hand-written parser producing exactly the same results,
+        which is several times faster.
 
         Default: ``PyParser``
         """
 
+        self.PARSER_CACHE_SIZE = 1000
+        """
+        Maximal number of parse results memoized by :obj:`CachingParser <pyslate.parser.CachingParser>`,
+        which wraps the parser used by Pyslate. Parser is not wrapped when set to 0.
+        If the parser specified in Pyslate constructor is already an instance of CachingParser,
+        then it's used as-is, so one cache can be shared by many Pyslate instances.
+
+        Default: ``1000``
+        """
+
+        self.RENDERER_CACHE_SIZE = 1000
+        """
+        Maximal number of tag values whose compiled render functions are kept by a Pyslate instance.
+        When it's exceeded, then the least recently used function is removed and compiled again when needed.
+
+        Default: ``1000``
+        """
+
         self.LOCALE_FORMAT_NUMBERS = True
         """
         If true, then all the floats being interpolated into variable fields are automatically localized
@@ -114,9 +177,9 @@ class DefaultConfig(object):
         """
 
         self.GLOBAL_DECORATORS = {
-            "capitalize": lambda x: x.capitalize(),
-            "upper": lambda x: x.upper(),
-            "lower": lambda x: x.lower(),
+            "capitalize": _capitalize,
+            "upper": _upper,
+            "lower": _lower,
         }
         """
         Dict containing decorators which are available for all languages.
@@ -126,17 +189,23 @@ class DefaultConfig(object):
         >>> pyslate.t("cookies@upper")
         I LIKE COOKIES
 
+        Built-in decorators are registered as deterministic, so their results are memorized and the results
+        of :obj:`Pyslate.translate <pyslate.pyslate.Pyslate.translate>` using them can be cached.
+        Decorators added to this dict are not deterministic. Deterministic ones should be registered using
+        :obj:`Pyslate.register_decorator <pyslate.pyslate.Pyslate.register_decorator>` with ``is_deterministic=True``.
+
         Default: see :ref:`Available_Decorators`
         """
 
         self.LANGUAGE_SPECIFIC_DECORATORS = {
             "en": {
-                "article": lambda name: ("an " if name[0].lower() in "aeiou" else "a ") + name,
+                "article": _article,
             }
         }
         """
         Dict containing decorators available only for a specific language.
         They are also available if language is current language's fallback or a global language fallback.
+        Like for global decorators, only the built-in ones are registered as deterministic.
         For information what decorators are - see doc of :attr:`GLOBAL_DECORATORS <pyslate.config.DefaultConfig.GLOBAL_DECORATORS>` variable.
 
         Default: see :ref:`Available_Decorators`
@@ -1,6 +1,52 @@
+import re
+import threading
+from collections import OrderedDict
+
 from ply import lex, yacc
 
 
+# matches anything which can make a tag value something else than a single plaintext:
+# start of a field, escape character or "$" or "%" followed by a character which is illegal after them
+_NOT_PLAINTEXT_REGEX = re.compile(r"[$%][{}\\:|?@]|\\")
+
+
+# lexer and parser tables are built once per process and then shared by all the lexer and parser instances
+_tables_lock = threading.Lock()
+
+
+def is_plaintext(text):
+    """
+    Returns True if text contains no fields nor escape characters, so parsing it would result in this text as-is.
+    """
+    return _NOT_PLAINTEXT_REGEX.search(text) is None
+
+
+# tag key with decorators, e.g. "item#p@upper", which contains no fields nor any other special syntax
+_SIMPLE_TAG_KEY_REGEX = re.compile(r"[^$%{}\\:|?@]+(@[^$%{}\\:|?@]+)*\Z")
+
+_split_tag_keys = {}
+
+_SPLIT_TAG_KEYS_LIMIT = 10000
+
+
+def split_tag_key(tag_key):
+    """
+    Splits a simple tag key like ``key#variant@dec1@dec2`` into a tuple of tag name and tuple of decorator names.
+    Results are memoized. Returns None if the tag key is not simple (e.g. it contains fields),
+    so it needs to be parsed as an inner tag field.
+    """
+    split_key = _split_tag_keys.get(tag_key)
+    if split_key is None:
+        if not _SIMPLE_TAG_KEY_REGEX.match(tag_key):
+            return None
+        key_parts = tag_key.split("@")
+        split_key = (key_parts[0], tuple(key_parts[1:]))
+        if len(_split_tag_keys) >= _SPLIT_TAG_KEYS_LIMIT:
+            _split_tag_keys.clear()
+        _split_tag_keys[tag_key] = split_key
+    return split_key
+
+
 class PyLexer(object):
 
     tokens = (
@@ -77,7 +123,22 @@ class PyLexer(object):
         self.nesting_depth = 0
 
     def build(self, **kwargs):
-        self.lexer = lex.lex(module=self, **kwargs)
+        """
+        Builds PLY lexer. Without keyword arguments it's a clone of a lexer built once and shared by all instances.
+        """
+        if kwargs:
+            self.lexer = lex.lex(module=self, **kwargs)
+        else:
+            self.lexer = self._get_shared_lexer().clone(self)
+            self.lexer.begin("INITIAL")  # clone doesn't rebind rules of the current state, so they'd update other lexer
+
+    @classmethod
+    def _get_shared_lexer(cls):
+        if "_shared_lexer" not in cls.__dict__:
+            with _tables_lock:
+                if "_shared_lexer" not in cls.__dict__:
+                    cls._shared_lexer = lex.lex(module=cls())
+        return cls._shared_lexer
 
     def input(self, data, *args, **kwargs):
         return self.lexer.input(data, *args, **kwargs)
@@ -180,60 +241,328 @@ class PyParser(object):
         p[0] = None
 
     def p_error(self, p):
-        raise PyslateException(self.data)
+        # grammar rules are bound to the instance which was used to build shared tables, so input is not known here
+        raise _GrammarError()
+
+    tokens = PyLexer.tokens
 
     def __init__(self):
-        self.tokens = PyLexer.tokens
-        self.data = None
-        self.lexer = PyLexer()
-        self.lexer.build()
-        self.parser = yacc.yacc(module=self, debug=0)
+        """
+        Creating a parser is cheap, because the lexer and the LALR tables are built lazily during the first parse
+        and then shared by all the instances. The tables are never written to the filesystem.
+        Parser keeps no state of a parse, so a single instance can be used by many threads at once.
+        """
+        self.parser = None
+
+    @classmethod
+    def _get_shared_parser(cls):
+        if "_shared_parser" not in cls.__dict__:
+            with _tables_lock:
+                if "_shared_parser" not in cls.__dict__:
+                    cls._shared_parser = yacc.yacc(module=cls(), debug=0, write_tables=False)
+        return cls._shared_parser
 
     def parse(self, data, **kwargs):
+        if self.parser is None:
+            self.parser = self._get_shared_parser()
+        lexer = PyLexer()  # lexer keeps state of the parse (e.g. nesting depth), so it's separate for each parse
+        lexer.build()
+        try:
+            return self.parser.parse(data, lexer=lexer, **kwargs)
+        except _GrammarError:
+            pass
+        raise PyslateException(data)
+
+
+class _GrammarError(Exception):
+    """Raised by PLY parser on syntax error, it's then converted into PyslateException with information about input"""
+
+
+class FastParser(object):
+    """
+    Hand-written parser producing exactly the same AST as :obj:`PyParser`, but without the generic PLY machinery.
+    Tokens are matched by a single regular expression built of the same token rules as :obj:`PyLexer` uses,
+    then they are parsed by a recursive descent parser for the same grammar.
+    """
+
+    _token_regex = re.compile("|".join("(?P<{}>{})".format(token_type, pattern) for token_type, pattern in (
+        ("DOL_LBRACE", PyLexer.t_DOL_LBRACE.__doc__),
+        ("PERC_LBRACE", PyLexer.t_PERC_LBRACE.__doc__),
+        ("COLON", PyLexer.t_COLON.__doc__),
+        ("PIPE", PyLexer.t_PIPE.__doc__),
+        ("AT", PyLexer.t_AT.__doc__),
+        ("QUESTION", PyLexer.t_QUESTION.__doc__),
+        ("RBRACE", PyLexer.t_RBRACE.__doc__),
+        ("ESCAPED", PyLexer.t_ESCAPED.__doc__),
+        ("PLAINTEXT", PyLexer.t_PLAINTEXT),
+    )))
+
+    _special_when_nested = frozenset(["COLON", "PIPE", "AT", "QUESTION"])
+
+    def parse(self, data):
+        return _FastParseState(data, self._tokenize(data)).expression()
+
+    def _tokenize(self, data):
+        """
+        Returns list of (type, value) tuples. Neighbouring plaintext tokens are merged into a single one,
+        because the grammar always treats them as a single plaintext.
+        In case of illegal character the last token is of type "ERROR" and it contains the error message.
+        """
+        tokens = []
+        nesting_depth = 0
+        position = 0
+        data_length = len(data)
+        match_token = self._token_regex.match
+        while position < data_length:
+            match = match_token(data, position)
+            if not match:
+                tokens.append(("ERROR", "Illegal character '%s' (line: %d:%d)" % (data[position], 1, position)))
+                break
+            token_type = match.lastgroup
+            value = match.group()
+            position = match.end()
+
+            if token_type in ("DOL_LBRACE", "PERC_LBRACE"):
+                nesting_depth += 1
+            elif token_type == "RBRACE":
+                if not nesting_depth:
+                    token_type = "PLAINTEXT"
+                else:
+                    nesting_depth -= 1
+            elif token_type == "ESCAPED":
+                token_type = "PLAINTEXT"
+                value = value[1:]
+            elif token_type in self._special_when_nested and not nesting_depth:
+                token_type = "PLAINTEXT"
+
+            if token_type == "PLAINTEXT" and tokens and tokens[-1][0] == "PLAINTEXT":
+                tokens[-1] = ("PLAINTEXT", tokens[-1][1] + value)
+            else:
+                tokens.append((token_type, value))
+        tokens.append(("END", None))
+        return tokens
+
+
+class _FastParseState(object):
+    """State of a single parse run of :obj:`FastParser`"""
+
+    def __init__(self, data, tokens):
         self.data = data
-        return self.parser.parse(data, lexer=self.lexer, **kwargs)
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        token_type = self.tokens[self.position][0]
+        if token_type == "ERROR":
+            raise PyslateException(self.tokens[self.position][1])
+        return token_type
+
+    def expect(self, token_type):
+        if self.peek() != token_type:
+            raise PyslateException(self.data)
+        value = self.tokens[self.position][1]
+        self.position += 1
+        return value
+
+    def expression(self):
+        nodes = []
+        while True:
+            token_type = self.peek()
+            if token_type == "PLAINTEXT":
+                nodes.append(self.expect("PLAINTEXT"))
+            elif token_type == "DOL_LBRACE":
+                nodes.append(self.inner_tag())
+            elif token_type == "PERC_LBRACE":
+                nodes.append(self.pholder_tag())
+            elif token_type == "END":
+                return nodes
+            else:
+                raise PyslateException(self.data)
+
+    def inner_tag(self):
+        self.expect("DOL_LBRACE")
+        tag_id = None
+        if self.peek() == "PLAINTEXT" and self.tokens[self.position + 1][0] == "COLON":
+            tag_id = self.expect("PLAINTEXT")
+            self.expect("COLON")
+
+        contents = []
+        while True:
+            token_type = self.peek()
+            if token_type == "PLAINTEXT":
+                contents.append(self.expect("PLAINTEXT"))
+            elif token_type == "PERC_LBRACE":
+                contents.append(self.pholder_tag())
+            else:
+                break
+        if not contents:
+            raise PyslateException(self.data)
+        decorators = self.decorators()
+        self.expect("RBRACE")
+        return InnerTagField(contents, tag_id=tag_id, decorators=decorators)
+
+    def pholder_tag(self):
+        self.expect("PERC_LBRACE")
+        name = self.expect("PLAINTEXT")
+        token_type = self.peek()
+        if token_type == "QUESTION":
+            cases = self.variants(name)
+            self.expect("RBRACE")
+            return SwitchField(cases, name)
+        if token_type == "COLON":
+            self.expect("COLON")
+            first_key = self.expect("PLAINTEXT")
+            cases = self.variants(first_key)
+            self.expect("RBRACE")
+            return SwitchField(cases, first_key, tag_id=name)
+
+        decorators = self.decorators()
+        self.expect("RBRACE")
+        return VariableField(name, decorators=decorators)
+
+    def variants(self, first_key):
+        cases = {}
+        case_key = first_key
+        while True:
+            self.expect("QUESTION")
+            case_value = ""
+            if self.peek() == "PLAINTEXT":
+                case_value = self.expect("PLAINTEXT")
+            cases[case_key] = case_value
+            if self.peek() != "PIPE":
+                return cases
+            self.expect("PIPE")
+            case_key = self.expect("PLAINTEXT")
+
+    def decorators(self):
+        decorators = []
+        while self.peek() == "AT":
+            self.expect("AT")
+            decorators.append(self.expect("PLAINTEXT"))
+        return decorators
+
+
+class CachingParser(object):
+    """
+    Wrapper for any parser which memoizes its results. Results are cached by the parsed string and when there are
+    more than max_size of them, then the least recently used result is removed.
+    Cached results are shared, so they are returned as tuples of (immutable) AST nodes.
+    It's thread-safe if the wrapped parser is thread-safe, so a single instance can be shared by many threads.
+    """
+
+    def __init__(self, parser, max_size=1000):
+        """
+        :param parser: parser whose results should be cached, e.g. instance of :obj:`PyParser` or :obj:`FastParser`
+        :param max_size: maximal number of cached results. If it's not positive, then nothing is cached
+        """
+        self.parser = parser
+        self.max_size = max_size
+        self.hits = 0
+        """Number of parse calls whose result was already cached"""
+        self.misses = 0
+        """Number of parse calls which needed to run the underlying parser"""
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, data):
+        with self._lock:
+            result = self._results.pop(data, None)
+            if result is not None:
+                self.hits += 1
+                self._results[data] = result  # reinserted as the most recently used one
+                return result
+            self.misses += 1
+
+        result = tuple(self.parser.parse(data))  # the lock is not held, so other threads don't wait for the parser
+        if self.max_size <= 0:
+            return result
+        with self._lock:
+            self._results.pop(data, None)
+            if len(self._results) >= self.max_size:
+                self._results.popitem(last=False)
+            self._results[data] = result
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def __len__(self):
+        return len(self._results)
+
+
+_interned_decorators = {}
+
+
+def _intern_decorators(decorators):
+    """Returns tuple of decorator names, which is shared by all nodes having the same decorators"""
+    decorators = tuple(decorators) if decorators else ()
+    return _interned_decorators.setdefault(decorators, decorators)
+
+
+class _Node(object):
+    """
+    Base class for immutable AST nodes. They are hashable and they can be safely shared, e.g. by the parse cache.
+    """
+    __slots__ = ()
+
+    def _fields(self):
+        return tuple(getattr(self, field_name) for field_name in self.__slots__)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AST node {} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("AST node {} is immutable".format(type(self).__name__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._fields() == other._fields()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self),) + self._fields())
+
 
+class InnerTagField(_Node):
+    __slots__ = ("contents", "tag_id", "decorators")
 
-class InnerTagField(object):
     def __init__(self, contents, tag_id=None, decorators=None):
-        self.contents = contents
-        self.tag_id = tag_id
-        self.decorators = decorators
-        if not decorators:
-            self.decorators = []
-        
-    def __eq__(self, other):
-        return self.contents == other.contents and self.tag_id == other.tag_id and self.decorators == other.decorators
+        object.__setattr__(self, "contents", tuple(contents))
+        object.__setattr__(self, "tag_id", tag_id)
+        object.__setattr__(self, "decorators", _intern_decorators(decorators))
 
     def __repr__(self):
-        return "innerTag(" + str(self.contents) + ", " + str(self.tag_id) + ", " + str(self.decorators) + ")"
+        return "innerTag(" + str(list(self.contents)) + ", " + str(self.tag_id) + ", " + str(list(self.decorators)) + ")"
 
 
-class VariableField(object):
-    def __init__(self, contents, decorators=None):
-        self.contents = contents
-        self.decorators = decorators
-        if not decorators:
-            self.decorators = []
+class VariableField(_Node):
+    __slots__ = ("contents", "decorators")
 
-    def __eq__(self, other):
-        return self.contents == other.contents
+    def __init__(self, contents, decorators=None):
+        object.__setattr__(self, "contents", contents)
+        object.__setattr__(self, "decorators", _intern_decorators(decorators))
 
     def __repr__(self):
         return "variable(" + str(self.contents) + ")"
 
 
-class SwitchField(object):
-    def __init__(self, cases, first_key, tag_id=None):
-        self.first_key = first_key
-        self.cases = cases
-        self.tag_id = tag_id
+class SwitchField(_Node):
+    """
+    Switch field whose cases are stored as a tuple of (key, value) pairs, in the same order as in the tag value.
+    """
+    __slots__ = ("cases", "first_key", "tag_id")
 
-    def __eq__(self, other):
-        return self.cases == other.cases and self.first_key == other.first_key
+    def __init__(self, cases, first_key, tag_id=None):
+        if isinstance(cases, dict):
+            cases = cases.items()
+        object.__setattr__(self, "cases", tuple(cases))
+        object.__setattr__(self, "first_key", first_key)
+        object.__setattr__(self, "tag_id", tag_id)
 
     def __repr__(self):
-        return "variants(" + str(self.cases) + ", " + self.first_key + ")"
+        return "variants(" + str(dict(self.cases)) + ", " + self.first_key + ")"
 
 
 class PyslateException(Exception):
@@ -1,11 +1,15 @@
 import copy
 import datetime
+import itertools
 import numbers
+import threading
+import weakref
 import six
 
-from .config import DefaultConfig
+from .cache import LRUCache, SingleFlight
+from .config import DefaultConfig, BUILTIN_DETERMINISTIC_DECORATORS
 from .locales import LOCALES
-from .parser import InnerTagField, VariableField, SwitchField, PyslateException
+from .parser import InnerTagField, VariableField, SwitchField, PyslateException, CachingParser, is_plaintext, split_tag_key
 
 
 class Pyslate(object):
@@ -15,7 +19,7 @@ class Pyslate(object):
     """
 
     def __init__(self, language, backend=None, config=DefaultConfig(), context=None,
-                 cache=None, locales=None, parser=None, on_missing_tag_key_callback=None):
+                 cache=None, locales=None, parser=None, on_missing_tag_key_callback=None, result_cache=None):
         """
         Constructor
 
@@ -27,6 +31,7 @@ class Pyslate(object):
         :param locales: this dict extends default dict of locales available in :obj:`locales.LOCALES <pyslate.pyslate.locales.LOCALES>`
         :param parser: see parser field
         :param on_missing_tag_key_callback: see on_missing_tag_key_callback field
+        :param result_cache: see result_cache field
         :return: object of Pyslate class
         """
 
@@ -46,15 +51,39 @@ class Pyslate(object):
         """
         Backend object is responsible for supplying values of tags for specified key and language
         from a persistent storage. It doesn't make any further processing nor doesn't interpret data.
+        It should implement method ``get_record(tag_names, languages)`` returning pair (content, form)
+        of the first existing tag, trying all tag names for the first language, then for the next language etc.,
+        or None if none of them exists. Form of the record is None if it's not set.
+        Backends without get_record method are asked using ``get_content`` and ``get_form`` methods
+        having the same arguments.
         """
 
         self.cache = cache
         """
         Object responsible for caching. It must implement the same methods as cache.SimpleMemoryCache.
+        For long-running processes it's recommended to use :obj:`cache.BoundedMemoryCache <pyslate.cache.BoundedMemoryCache>`.
+        Many processes can share the cached records using :obj:`cache.TwoTierCache <pyslate.cache.TwoTierCache>`.
+        Cached records can be invalidated after changes in the backend using
+        :obj:`cache.VersionedCache <pyslate.cache.VersionedCache>`.
+        Records can be refreshed in background instead of expiring using
+        :obj:`cache.RevalidatingCache <pyslate.cache.RevalidatingCache>`.
         If cache is not needed, then it can be None.
         Even if specified, cache may not be used when ``config.ALLOW_CACHE`` is False.
         """
 
+        self.result_cache = result_cache
+        """
+        Object responsible for caching the results of :obj:`translate`, e.g. :obj:`cache.LRUCache <pyslate.cache.LRUCache>`.
+        It must implement methods ``get(key)`` and ``set(key, value)``. If not needed, then it can be None.
+        The result is cached only if all kwargs and context values are strings, numbers, dates, times, None or
+        lists, tuples and dicts of them. It's not cached if any non-deterministic custom function was used
+        or any tag was missing. Tag values are cached until they are evicted from the result cache,
+        so it's a good idea to set its ttl.
+        Results of different instances of Pyslate are cached under different keys, because they can have
+        different backends, locales or registered functions, so sharing a result cache between them doesn't help.
+        Even if specified, result cache is not used when ``config.ALLOW_CACHE`` is False.
+        """
+
         self.locales = copy.deepcopy(LOCALES)
         """
         Dict containing information about locales available in the application.
@@ -63,6 +92,7 @@ class Pyslate(object):
         Keyword argument `locales` does extend, not replace the default set of locales.
         Locales specified in keyword argument takes higher precedence over default locales.
         For examples of correct locale specification see :obj:`pyslate.locales.LOCALES`
+        Locale of a language is resolved once, so the dict can be replaced, but it shouldn't be modified in place.
         """
         if locales:
             self.locales = dict(self.locales, **locales)
@@ -83,6 +113,16 @@ class Pyslate(object):
 
         self._functions = {}
 
+        # language => _LanguageTable, rebuilt when fallbacks of the language or registrations change
+        self._language_tables = {}
+
+        # changed on every registration of function or decorator, because they can change results of translation.
+        # Numbers are unique among all the instances, so results of different instances never share a result key
+        self._registrations_version = next(_registration_numbers)
+
+        # per-thread counter of calls which make the translation impossible to cache, see result_cache field
+        self._local = threading.local()
+
         # dictionary storing info whether function/decorator is being deterministic and their cache
         # are shared between functions and decorators
         self.functions_deterministic = {}
@@ -95,23 +135,41 @@ class Pyslate(object):
         self.functions_memory = {}
         """
         A dictionary used as cache for deterministic functions and decorators.
-        Key is a function/decorator name and value is a tuple containing a pair:
-        list of input arguments, result. It's discouraged to access it manually except clearing it.
+        Key is a function/decorator name and value is :obj:`cache.LRUCache <pyslate.cache.LRUCache>`
+        whose keys are based on input arguments and values are results. Its ``hits`` and ``misses`` counters
+        can be used to check if memoization of the function is worth it.
+        Results are memoized only if all arguments are strings, numbers, dates, times, None or lists, tuples and dicts
+        of them. It's discouraged to access it manually except clearing it or reading statistics.
         """
 
-        # load default available decorators
+        # load default available decorators, only the built-in ones are known to be deterministic
         for decorator_name in config.GLOBAL_DECORATORS:
-            self.register_decorator(decorator_name, config.GLOBAL_DECORATORS[decorator_name])
+            decorator = config.GLOBAL_DECORATORS[decorator_name]
+            self.register_decorator(decorator_name, decorator,
+                                    is_deterministic=decorator in BUILTIN_DETERMINISTIC_DECORATORS)
         for language in config.LANGUAGE_SPECIFIC_DECORATORS:
             decorators_for_language = config.LANGUAGE_SPECIFIC_DECORATORS[language]
             for decorator_name in decorators_for_language:
-                self.register_decorator(decorator_name, decorators_for_language[decorator_name], language=language)
+                decorator = decorators_for_language[decorator_name]
+                self.register_decorator(decorator_name, decorator, language=language,
+                                        is_deterministic=decorator in BUILTIN_DETERMINISTIC_DECORATORS)
 
-        self.parser = parser if parser else config.PARSER_CLASS()
+        self.parser = parser if parser is not None else config.PARSER_CLASS()
         """
         Object responsible for parsing the tag value string to get Abstract Syntax Tree to support
         variable, inner tag and switch fields. Default implementation is a pure-python PLY parser.
+        Unless ``config.PARSER_CACHE_SIZE`` is 0, the parser is wrapped in
+        :obj:`CachingParser <pyslate.parser.CachingParser>` which memoizes its results.
+        The wrapper belongs to this instance, so when many instances are created (e.g. one per request),
+        then a single CachingParser should be passed to all of them.
         """
+        if config.PARSER_CACHE_SIZE and not isinstance(self.parser, CachingParser):
+            self.parser = CachingParser(self.parser, config.PARSER_CACHE_SIZE)
+
+        # functions rendering tag values, compiled from the parsed tag value and cached by the raw tag value.
+        # They call methods of this instance, so they can't be shared. To avoid parsing the tag values again
+        # by every short-lived instance (e.g. one per request), share the CachingParser given as parser argument
+        self._renderers = LRUCache(max_size=config.RENDERER_CACHE_SIZE)
 
         if context is None:  # handle default value
             context = {}
@@ -127,7 +185,7 @@ class Pyslate(object):
         self.on_missing_tag_key_callback = on_missing_tag_key_callback
         """
         Contains two-parameter function which is run when some tag value cannot be got from the backend.
-        It should return string which is written to the output instead of the missing tag.
+        It should return string which is written to the output as-is instead of the missing tag.
         The first parameter is tag key, the second is dict of interpolable parameters (a.k.a. kwargs).
         You can replace it with your own implementation having some side-effect, for example logging of the missing tags.
         """
@@ -142,27 +200,73 @@ class Pyslate(object):
         :param kwargs: arguments which can be interpolated into tag value
         :return: translated value for specified tag key.
         """
-        # treat main specified tag as inner tag
-        tag_name = "${" + tag_name + "}"
+        result_key = None
+        if self.result_cache is not None and self.config.ALLOW_CACHE:
+            result_key = self._get_result_key(tag_name, kwargs)
+        if result_key is None:
+            return self._translate_tag_key(tag_name, kwargs)
+
+        t9n = self.result_cache.get(result_key)
+        if t9n is None:
+            volatile_calls = self._count_volatile_calls()
+            t9n = self._translate_tag_key(tag_name, kwargs)
+            if self._count_volatile_calls() == volatile_calls:
+                self.result_cache.set(result_key, t9n)
+        return t9n
 
-        # parse it to get tag key, remove (unnecessary) id and take its decorators
-        inner_tag_node = self.parser.parse(tag_name)[0]
-        tag_name = inner_tag_node.contents[0]
+    def _translate_tag_key(self, tag_name, kwargs):
+        split_key = split_tag_key(tag_name)
+        if split_key is None:
+            # treat main specified tag as inner tag and parse it to get tag key,
+            # remove (unnecessary) id and take its decorators
+            inner_tag_node = self.parser.parse("${" + tag_name + "}")[0]
+            split_key = inner_tag_node.contents[0], inner_tag_node.decorators
+        tag_name, decorators = split_key
 
         t9n = self._translate(tag_name, **kwargs)[0]
 
-        for decorator_name in inner_tag_node.decorators:
+        for decorator_name in decorators:
             t9n = self._call_decorator(decorator_name, t9n)
 
         return t9n
 
+    def _get_result_key(self, tag_name, kwargs):
+        """Returns key of the result cache or None if the result can't be cached"""
+        arguments = _freeze(dict(self.context, **kwargs))
+        if arguments is None:
+            return None
+        return (tag_name, self._get_language_table().languages, self._registrations_version,
+                self._get_cache_generation(), arguments)
+
+    def _get_cache_generation(self):
+        """Returns number which changes when the records in the cache are invalidated, e.g. by VersionedCache"""
+        check_version = getattr(self.cache, "check_version", None)
+        if check_version is None:
+            return None
+        return check_version()
+
+    @staticmethod
+    def _get_memory_key(language, *arguments):
+        """Returns key of functions_memory or None if result for these arguments can't be memorized"""
+        frozen_arguments = _freeze(arguments)
+        if frozen_arguments is None:
+            return None
+        return language, frozen_arguments
+
+    def _count_volatile_calls(self):
+        return getattr(self._local, "volatile_calls", 0)
+
+    def _mark_volatile_call(self):
+        """Marks that the result of current translation is not deterministic, so it can't be cached"""
+        self._local.volatile_calls = self._count_volatile_calls() + 1
+
     def _translate(self, tag_name, **kwargs):
 
         kwargs = dict(self.context, **kwargs)  # add context variables, which have lower priority
+        language_table = self._get_language_table()
 
         if "number" in kwargs:
-            number_variant = self._first_left_value_from(self.locales, self._get_languages())["number_rule"](
-                kwargs["number"])
+            number_variant = language_table.number_rule(kwargs["number"])
 
             base_variant_parts = tag_name.partition("#")
             tag_name = base_variant_parts[0] + "#" + number_variant + base_variant_parts[2]
@@ -174,23 +278,34 @@ class Pyslate(object):
         variant = tag_name.partition("#")[2]
         kwargs["tag_v"] = variant
 
-        if tag_base in self._functions:
-            function_language = self._first_left_key_from(self._functions[tag_base], self._get_languages())
-            if (self.functions_deterministic[tag_base]  # deterministic function so maybe result is already known
-                    and tuple([function_language] + sorted(kwargs.items())) in self.functions_memory[tag_name]):
-                t9n, form = self.functions_memory[tag_name][tuple([function_language] + sorted(kwargs.items()))]
+        function_entry = language_table.functions.get(tag_base)
+        if function_entry is not None:
+            function_language, function_for_language = function_entry
+            memory_key = None
+            if self.functions_deterministic[tag_base]:  # deterministic function so maybe result is already known
+                memory_key = self._get_memory_key(function_language, tag_name, kwargs)
             else:
-                helper = PyslateHelper(self)
-                function_for_language = self._first_left_value_from(self._functions[tag_base], self._get_languages())
+                self._mark_volatile_call()
+
+            memorized_result = None
+            if memory_key is not None:
+                memorized_result = self.functions_memory[tag_base].get(memory_key)
 
+            if memorized_result is not None:
+                t9n, form = memorized_result
+            else:
+                helper = PyslateHelper(self)
                 t9n = function_for_language(helper, tag_name, kwargs)
                 form = helper.returned_form
-                if self.functions_deterministic[tag_base]:
-                    self.functions_memory[tag_name][tuple([function_language] + sorted(kwargs.items()))] = (t9n, form)
+                if memory_key is not None:
+                    self.functions_memory[tag_base].set(memory_key, (t9n, form))
         else:
-            t9n, form = self._get_raw_content(tag_name, kwargs), self._get_raw_form(tag_name)
-            nodes = self.parser.parse(t9n)
-            t9n = self._traverse(nodes, kwargs)
+            content, form = self._get_raw_record(tag_name)
+            if content is None:  # output of the callback is neither compiled nor cached, it's written as-is
+                self._mark_volatile_call()
+                t9n = self.on_missing_tag_key_callback(tag_name, kwargs)
+            else:
+                t9n = self._get_renderer(content)(kwargs)
 
         return t9n, form
 
@@ -218,7 +333,7 @@ class Pyslate(object):
         :param value: value to be localized
         :return: string representation of the value, localized if being instance of the supported types
         """
-        locale_data = self._first_left_value_from(self.locales, self._get_languages())
+        locale_data = self._get_language_table().locale
         if not self.config.LOCALE_FORMAT_NUMBERS:
             return str(value)
         if isinstance(value, float):
@@ -249,7 +364,48 @@ class Pyslate(object):
     l = localize
     "Alias for :obj:`localize`"
 
-    def register_decorator(self, decorator_name, function, is_deterministic=False, language=None):
+    def preload(self, languages=None, prefix=None):
+        """
+        Fills the cache with records of all the tags available for specified languages, so no backend calls
+        are needed later. All the records are got using a single bulk read from the backend
+        and fallbacks are resolved in the same way as for a single tag.
+        Backend must implement get_all_records method.
+
+        :param languages: list of main languages whose records should be cached.
+               If unspecified then only the current language is used
+        :param prefix: if specified then only tags whose names start with prefix are preloaded
+        :return: number of records saved in the cache
+        """
+        if self.cache is None or not self.config.ALLOW_CACHE:
+            return 0
+        if languages is None:
+            languages = [self.language]
+
+        language_chains = [self._get_languages(language) for language in languages]
+        all_languages = sorted(set(language for chain in language_chains for language in chain))
+        records = self.backend.get_all_records(all_languages, prefix=prefix)
+
+        saved_count = 0
+        for chain in language_chains:
+            for tag_name in records:
+                record = self._first_record_from(records, self._get_requested_tags(tag_name)[0], chain)
+                if record is None:
+                    continue
+                self.cache.save(tag_name, chain[0], record[0], record[1])
+                saved_count += 1
+        return saved_count
+
+    @staticmethod
+    def _first_record_from(records, tag_names, languages):
+        """Returns the first (content, form) record using the same order of lookups as the backends"""
+        for language in languages:
+            for tag_name in tag_names:
+                if language in records.get(tag_name, {}):
+                    return records[tag_name][language]
+        return None
+
+    def register_decorator(self, decorator_name, function, is_deterministic=False, language=None,
+                           memory_size=1000, memory_ttl=None):
         """
         Registers a new decorator which will be available in the translation system.
         Overwrites any other decorator or function with the same name.
@@ -259,6 +415,8 @@ class Pyslate(object):
         :param is_deterministic: if True then return value of the decorator for specified arguments will be cached
                to be reused in the future. Keep it disabled unless you really know you need it.
         :param language: language for which decorator will be available, If unspecified then it's available for all languages
+        :param memory_size: maximal number of cached results of a deterministic decorator
+        :param memory_ttl: number of seconds after which cached result expires. If None, then it never expires
 
         """
         if decorator_name in self._functions:
@@ -270,11 +428,13 @@ class Pyslate(object):
         if decorator_name not in self._decorators:  # no such decorator for any language yet, so create a dict for it
             self._decorators[decorator_name] = {}
         self._decorators[decorator_name][language] = function
+        self._registrations_version = next(_registration_numbers)
 
         self.functions_deterministic[decorator_name] = is_deterministic
-        self.functions_memory[decorator_name] = {}
+        self.functions_memory[decorator_name] = LRUCache(max_size=memory_size, ttl=memory_ttl)
 
-    def register_function(self, tag_name, function, is_deterministic=False, language=None):
+    def register_function(self, tag_name, function, is_deterministic=False, language=None,
+                          memory_size=1000, memory_ttl=None):
         """
         Registers a new custom function which will be available in the translation system.
         Overwrites any other decorator or function with the same name.
@@ -288,6 +448,8 @@ class Pyslate(object):
         :param is_deterministic: if True then return value and grammatical form of the function for specified arguments
                will be cached to be reused in the future. Keep it disabled unless you really know you need it.
         :param language: language for which function will be available. If unspecified then it's available for all languages
+        :param memory_size: maximal number of cached results of a deterministic function
+        :param memory_ttl: number of seconds after which cached result expires. If None, then it never expires
 
         """
         if tag_name in self._decorators:
@@ -299,100 +461,194 @@ class Pyslate(object):
         if tag_name not in self._functions:  # no such function for any language yet, so create a dict for it
             self._functions[tag_name] = {}
         self._functions[tag_name][language] = function
+        self._registrations_version = next(_registration_numbers)
 
         self.functions_deterministic[tag_name] = is_deterministic
-        self.functions_memory[tag_name] = {}
+        self.functions_memory[tag_name] = LRUCache(max_size=memory_size, ttl=memory_ttl)
 
-    def _get_raw_content(self, tag_name, kwargs):
-        """Gets and returns content from backend considering all possible tag and language fallbacks"""
+    def _get_raw_record(self, tag_name):
+        """
+        Gets and returns tuple of content and grammatical form from cache or backend
+        considering all possible tag and language fallbacks. Form is None if no form is set.
+        Both values are cached together under the requested tag key and the main language.
+        If the tag is missing, then content is None and it's remembered in the cache as such a record.
+        """
+        languages = self._get_language_table().languages
+        use_cache = self.cache is not None and self.config.ALLOW_CACHE
 
+        record = None
+        if use_cache:
+            load_with_refresh = getattr(self.cache, "load_with_refresh", None)
+            if load_with_refresh is not None:  # cache can refresh stale records in background
+                record = load_with_refresh(tag_name, languages[0], lambda: self._fetch_record(tag_name, languages))
+            else:
+                record = self.cache.load(tag_name, languages[0])
+
+        if record is None:
+            saved = []
+
+            def fetch_and_save():
+                content, form = self._fetch_record(tag_name, languages)
+                self._save_record(tag_name, languages[0], content, form)
+                saved.append(True)
+                return content, form
+
+            single_flight = _get_single_flight(self.backend) if self.config.COALESCE_BACKEND_CALLS else None
+            if single_flight is not None:
+                # record is saved before the call is finished, so no other thread misses the cache in the meantime
+                record = single_flight.do((tag_name, languages), fetch_and_save)
+                if not saved:  # result of a call made by another instance, which can have another cache
+                    self._save_record(tag_name, languages[0], record[0], record[1])
+            else:
+                record = fetch_and_save()
+        return record
+
+    def _save_record(self, tag_name, language, content, form):
+        """Saves the record fetched from the backend in the cache, if it's used"""
+        if self.cache is None or not self.config.ALLOW_CACHE:
+            return
+        if content is not None or self.config.CACHE_MISSING_TAGS:
+            self.cache.save(tag_name, language, content, form)
+
+    def _fetch_record(self, tag_name, languages):
+        """Gets tuple of content and grammatical form from the backend, bypassing the cache"""
+        requested_tags, form_requested_tags = self._get_requested_tags(tag_name)
+        get_record = getattr(self.backend, "get_record", None)
+        if get_record is None:  # backend implementing the older protocol
+            content = self.backend.get_content(requested_tags, languages)
+            form = self.backend.get_form(form_requested_tags, languages)
+            return content, form
+
+        record = get_record(requested_tags, languages)
+        if not record:
+            return None, None
+        return record[0], record[1]
+
+    @staticmethod
+    def _get_requested_tags(tag_name):
+        """
+        Returns tuple of two lists: tag keys whose content can be used for the specified tag key
+        and tag keys whose form can be used, both in the order of preference.
+        """
         requested_tags = [tag_name]
+        form_requested_tags = [tag_name]
         if "#" in tag_name:
             tag_and_variant = tag_name.partition("#")
             for i in range(len(tag_and_variant[2]) - 1, 0, -1):
                 requested_tags += [tag_and_variant[0] + tag_and_variant[1] + tag_and_variant[2][:i]]
             requested_tags += [tag_and_variant[0]]
-
-        if self.cache and self.config.ALLOW_CACHE:
-            cached_content = self.cache.load(requested_tags[0], self._get_languages()[0])
-            if cached_content is not None:
-                return cached_content
-
-        retrieved_content = self.backend.get_content(requested_tags, self._get_languages())
-        if retrieved_content is None:
-            retrieved_content = self.on_missing_tag_key_callback(requested_tags[0], kwargs)
-        elif self.cache and self.config.ALLOW_CACHE:
-            self.cache.save(tag_name, self.language, retrieved_content)
-        return retrieved_content
-
-    def _get_languages(self):
-        languages = [self.language]
-        if self.language in self.fallbacks:
-            languages += [self.fallbacks[self.language]]
+            form_requested_tags += [tag_and_variant[0]]
+        return requested_tags, form_requested_tags
+
+    def _get_language_table(self):
+        """
+        Returns _LanguageTable for the current language. It's rebuilt only when the language's fallback,
+        global fallback or registered decorators and functions change.
+        """
+        language = self.language
+        key = (self.fallbacks.get(language), self.global_fallback, self._registrations_version, id(self.locales))
+        language_table = self._language_tables.get(language)
+        if language_table is None or language_table.key != key:
+            language_table = _LanguageTable(key, self._get_languages(language), self.locales,
+                                            self._decorators, self._functions)
+            self._language_tables[language] = language_table
+        return language_table
+
+    def _get_languages(self, language=None):
+        if language is None:
+            language = self.language
+        languages = [language]
+        if language in self.fallbacks:
+            languages += [self.fallbacks[language]]
         languages += [self.global_fallback]
         return languages
 
-    def _get_raw_form(self, tag_name):
-        """Returns grammatical form got from backend considering all possible tag and language fallbacks
-        Returns none if no form is set"""
-        requested_tags = [tag_name]
-        if "#" in tag_name:
-            requested_tags += [tag_name.partition("#")[0]]
+    def _get_renderer(self, t9n):
+        """Returns function rendering the tag value for specified kwargs. Compiled functions are cached by raw tag value"""
+        renderer = self._renderers.get(t9n)
+        if renderer is None:
+            if is_plaintext(t9n):  # most of tag values have no fields, so there's no need to parse them
+                renderer = lambda kwargs: t9n
+            else:
+                renderer = self._compile(self.parser.parse(t9n))
+            self._renderers.set(t9n, renderer)
+        return renderer
+
+    def _compile(self, nodes):
+        """
+        Turns a list of AST nodes into a single-argument function which takes kwargs and returns the rendered text.
+        All inner tags are rendered before variable and switch fields, because switch fields can depend on
+        grammatical forms of the inner tags.
+        """
+        texts = []
+        inner_tags = []
+        fields = []
+        for position, node in enumerate(nodes):
+            if isinstance(node, six.string_types):
+                texts.append(node)
+                continue
+            texts.append(None)
+            if isinstance(node, InnerTagField):
+                inner_tags.append((position, self._compile_inner_tag(node)))
+            elif isinstance(node, (VariableField, SwitchField)):
+                fields.append((position, self._compile_field(node)))
+            else:
+                raise PyslateException("invalid node: {} of type {} in parsed text".format(node, type(node)))
 
-        languages = self._get_languages()
-        return self.backend.get_form(requested_tags, languages)
+        if not inner_tags and not fields:  # plaintext only, so it can be joined once
+            text = "".join(texts)
+            return lambda kwargs: text
 
-    def _traverse(self, nodes, kwargs):
-        nodes_after_replacing_inner_tags = []
-        forms_by_id = {}
-        for node in nodes:
-            text, form_by_id_dict = self._replace_inner_tag_or_pass(node, kwargs)
-            nodes_after_replacing_inner_tags.append(text)
-            forms_by_id.update(form_by_id_dict)
+        def render(kwargs):
+            rendered_texts = list(texts)
+            forms_by_id = {}
+            for inner_tag_position, render_inner_tag in inner_tags:
+                rendered_texts[inner_tag_position], form_by_id_dict = render_inner_tag(kwargs)
+                forms_by_id.update(form_by_id_dict)
+            for field_position, render_field in fields:
+                rendered_texts[field_position] = render_field(kwargs, forms_by_id)
+            return "".join(rendered_texts)
 
-        fully_interpreted_nodes = []
-        for node in nodes_after_replacing_inner_tags:
-            fully_interpreted_nodes.append(self._interpolate_variable_or_switch_field(node, kwargs, forms_by_id))
+        return render
 
-        return "".join(fully_interpreted_nodes)
+    def _compile_inner_tag(self, node):
+        render_tag_name = self._compile(node.contents)
 
-    def _replace_inner_tag_or_pass(self, node, kwargs):
-        if not isinstance(node, InnerTagField):  # do nothing
-            return node, {}
+        def render_inner_tag(kwargs):
+            tag_name = render_tag_name(kwargs)
 
-        tag_name = self._traverse(node.contents, kwargs)
+            if not self.config.ALLOW_INNER_TAGS:  # when inner tags are disabled then print them as-is
+                return "${" + tag_name + "}", {}
+            final_kwargs = kwargs
 
-        if not self.config.ALLOW_INNER_TAGS:  # when inner tags are disabled then print them as-is
-            return "${" + tag_name + "}", {}
-        final_kwargs = kwargs
+            if node.tag_id:  # if this inner tag has a string ID, like that: ${ID:some_value}
+                if "groups" in kwargs:
+                    final_kwargs = dict(kwargs)
+                    del final_kwargs["groups"]
+                    # available kwargs can be overwritten by elements of dict, which is a group specific for this tag's id
+                    final_kwargs.update(kwargs["groups"][node.tag_id])
 
-        if node.tag_id:  # if this inner tag has a string ID, like that: ${ID:some_value}
-            if "groups" in kwargs:
-                final_kwargs = dict(kwargs)
-                del final_kwargs["groups"]
-                # available kwargs can be overwritten by elements of dict, which is a group specific for this tag's id
-                final_kwargs.update(kwargs["groups"][node.tag_id])
+            text, form = self._translate(tag_name, **final_kwargs)
 
-        text, form = self._translate(tag_name, **final_kwargs)
+            for decorator_name in node.decorators:
+                text = self._call_decorator(decorator_name, text)
 
-        for decorator_name in node.decorators:
-            text = self._call_decorator(decorator_name, text)
-
-        if not node.tag_id:
-            return text, {}
-        return text, {node.tag_id: form}
-
-    def _interpolate_variable_or_switch_field(self, node, kwargs, forms):
-        if isinstance(node, six.string_types):  # just return the string
-            return node
-        elif isinstance(node, VariableField):
-            return self._replace_variable_fields(node, kwargs)
-        elif isinstance(node, SwitchField):
+            if not node.tag_id:
+                return text, {}
+            return text, {node.tag_id: form}
+
+        return render_inner_tag
+
+    def _compile_field(self, node):
+        if isinstance(node, VariableField):
+            return lambda kwargs, forms: self._replace_variable_fields(node, kwargs)
+
+        def render_switch_field(kwargs, forms):
             if not self.config.ALLOW_SWITCH_FIELDS:
                 return ""
             return self._replace_switch_fields(node, kwargs, forms)
-        else:
-            raise PyslateException("invalid node: {} of type {} in parsed text".format(node, type(node)))
+
+        return render_switch_field
 
     def _replace_variable_fields(self, node, kwargs):
         if node.contents not in kwargs and node.contents not in self.context:
@@ -422,29 +678,118 @@ class Pyslate(object):
         elif param_name in forms and self._contained_in(forms[param_name], node.cases) is not False:
             return self._contained_in(forms[param_name], node.cases)
         else:
-            return node.cases[node.first_key]
+            for case_key, case_value in node.cases:
+                if case_key == node.first_key:
+                    return case_value
 
     def _call_decorator(self, decorator_name, value):
-        try:
-            decorator_language = self._first_left_key_from(self._decorators[decorator_name], self._get_languages())
+        language_table = self._get_language_table()
+        decorator_entry = language_table.decorators.get(decorator_name)
+        if decorator_entry is None:
+            raise PyslateException("No decorator with name '{}' for main language or any of its fallbacks {}".
+                                   format(decorator_name, list(language_table.languages)))
+        decorator_language, decorator = decorator_entry
 
-            if (self.functions_deterministic[decorator_name]  # deterministic function so maybe result is already known
-                and tuple([decorator_language, value]) in self.functions_memory[decorator_name]):
-                return self.functions_memory[decorator_name][tuple([decorator_language, value])]
+        if not self.functions_deterministic[decorator_name]:
+            self._mark_volatile_call()
+            return decorator(value)
 
-            decorator = self._decorators[decorator_name][decorator_language]
+        # deterministic function so maybe result is already known
+        memory_key = self._get_memory_key(decorator_language, value)
+        if memory_key is None:
             return decorator(value)
-        except KeyError:
-            raise PyslateException("No decorator with name '{}' for main language or any of its fallbacks {}".
-                                   format(decorator_name, self._get_languages()))
+        result = self.functions_memory[decorator_name].get(memory_key, _NOT_MEMORIZED)
+        if result is _NOT_MEMORIZED:
+            result = decorator(value)
+            self.functions_memory[decorator_name].set(memory_key, result)
+        return result
 
     def _contained_in(self, param, cases):
-        for case_key in cases.keys():
+        for case_key, case_value in cases:
             if case_key in param:
-                return cases[case_key]
+                return case_value
         return False
 
 
+_NOT_MEMORIZED = object()
+
+_registration_numbers = itertools.count(1)
+
+# backend => SingleFlight coalescing concurrent lookups of the same tag, shared by all Pyslate instances
+_single_flights = weakref.WeakKeyDictionary()
+_single_flights_lock = threading.Lock()
+
+
+def _get_single_flight(backend):
+    """Returns SingleFlight for the backend or None if the backend can't be weakly referenced"""
+    try:
+        single_flight = _single_flights.get(backend)
+        if single_flight is None:
+            with _single_flights_lock:
+                single_flight = _single_flights.get(backend)
+                if single_flight is None:
+                    single_flight = _single_flights[backend] = SingleFlight()
+        return single_flight
+    except TypeError:
+        return None
+
+
+class _LanguageTable(object):
+    """
+    Everything needed for a translation which depends only on the language chain: the chain itself, locale,
+    plural rule and decorators and functions available for the chain, as dicts: name => (language, function).
+    """
+
+    __slots__ = ("key", "languages", "locale", "number_rule", "decorators", "functions")
+
+    def __init__(self, key, languages, locales, decorators, functions):
+        self.key = key
+        self.languages = tuple(languages)
+        self.locale = Pyslate._first_left_value_from(locales, languages)
+        self.number_rule = self.locale["number_rule"] if self.locale else None
+        self.decorators = self._resolve(decorators, languages)
+        self.functions = self._resolve(functions, languages)
+
+    @staticmethod
+    def _resolve(functions_by_language, languages):
+        resolved = {}
+        for name, functions in functions_by_language.items():
+            language = Pyslate._first_left_key_from(functions, languages)
+            if language is not None:
+                resolved[name] = language, functions[language]
+        return resolved
+
+
+_IMMUTABLE_TYPES = six.string_types + (numbers.Number, type(None), datetime.date, datetime.time)
+
+
+def _freeze(value):
+    """
+    Returns hashable representation of the value, which is equal only for equal values of the same type.
+    Returns None if value is of any other type than the known immutable types or lists, tuples and dicts of them.
+    """
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return type(value), value
+    if isinstance(value, (list, tuple)):
+        frozen_items = tuple(_freeze(item) for item in value)
+        if None in frozen_items:
+            return None
+        return type(value), frozen_items
+    if isinstance(value, dict):
+        frozen_items = []
+        for key, item in value.items():
+            frozen_item = _freeze(item)
+            if frozen_item is None:
+                return None
+            frozen_items.append((key, frozen_item))
+        try:
+            frozen_items.sort()
+        except TypeError:  # keys can't be compared
+            return None
+        return dict, tuple(frozen_items)
+    return None
+
+
 class PyslateHelper(object):
     """
     Class given as a first argument of the custom functions. It's a facade which allows for translating
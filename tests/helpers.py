@@ -0,0 +1,148 @@
+import fnmatch
+import socket
+
+import six
+
+
+class FakeTimer(object):
+    """Function returning current time, which is changed by the test"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RedisStub(object):
+    """
+    Stand-in for StrictRedis implementing only the commands used by pyslate.
+    Hashes, strings and sorted sets are kept in dicts and values are returned as bytes like by redis-py.
+    """
+
+    def __init__(self, hashes=None):
+        self.hashes = dict((key, dict(value)) for key, value in (hashes or {}).items())
+        self.strings = {}
+        self.sorted_sets = {}
+        self.expirations = {}
+        self.reachable = True
+        self.commands = []
+
+    @staticmethod
+    def _encode(value):
+        if value is None or isinstance(value, bytes):
+            return value
+        return six.text_type(value).encode("utf-8")
+
+    @staticmethod
+    def _decode(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def _check(self, command):
+        if not self.reachable:
+            raise socket.error("connection refused")
+        self.commands.append(command)
+
+    def pipeline(self, transaction=True):
+        return RedisPipelineStub(self)
+
+    def get(self, key):
+        self._check("get")
+        return self._encode(self.strings.get(key))
+
+    def set(self, key, value):
+        self._check("set")
+        self.strings[key] = value
+
+    def exists(self, key):
+        self._check("exists")
+        return int(key in self.hashes or key in self.strings or key in self.sorted_sets)
+
+    def delete(self, *keys):
+        self._check("delete")
+        for key in keys:
+            key = self._decode(key)
+            for values in (self.hashes, self.strings, self.sorted_sets):
+                values.pop(key, None)
+
+    def expire(self, key, seconds):
+        self._check("expire")
+        self.expirations[key] = seconds
+
+    def hget(self, key, field):
+        self._check("hget")
+        return self._encode(self.hashes.get(key, {}).get(field))
+
+    def hmget(self, key, fields):
+        self._check("hmget")
+        return [self._encode(self.hashes.get(key, {}).get(field)) for field in fields]
+
+    def hgetall(self, key):
+        self._check("hgetall")
+        if key in self.strings or key in self.sorted_sets:
+            raise TypeError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return dict((self._encode(field), self._encode(value)) for field, value in self.hashes.get(key, {}).items())
+
+    def hset(self, key, field, value):
+        self._check("hset")
+        self.hashes.setdefault(key, {})[field] = self._decode(value)
+
+    def zadd(self, key, mapping):
+        self._check("zadd")
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zrange(self, key, start, end, withscores=False):
+        self._check("zrange")
+        members = sorted(self.sorted_sets.get(key, {}).items(), key=lambda member: (member[1], member[0]))
+        members = members[start:] if end == -1 else members[start:end + 1]
+        if withscores:
+            return [(self._encode(member), float(score)) for member, score in members]
+        return [self._encode(member) for member, score in members]
+
+    def zrangebyscore(self, key, min_score, max_score, withscores=False):
+        self._check("zrangebyscore")
+        min_score = str(min_score)
+        exclusive = min_score.startswith("(")
+        min_value = float(min_score.lstrip("("))
+        max_value = float(max_score)
+        members = [(member, score) for member, score in sorted(self.sorted_sets.get(key, {}).items(),
+                                                               key=lambda member: (member[1], member[0]))
+                   if (score > min_value if exclusive else score >= min_value) and score <= max_value]
+        if withscores:
+            return [(self._encode(member), float(score)) for member, score in members]
+        return [self._encode(member) for member, score in members]
+
+    def zunionstore(self, destination, keys):
+        self._check("zunionstore")
+        union = {}
+        for key in keys:
+            for member, score in self.sorted_sets.get(key, {}).items():
+                union[member] = union.get(member, 0) + score
+        self.sorted_sets[destination] = union
+
+    def scan_iter(self, match, count=None):
+        self._check("scan")
+        keys = list(self.hashes) + list(self.strings) + list(self.sorted_sets)
+        return [self._encode(key) for key in keys if fnmatch.fnmatchcase(key, match)]
+
+
+class RedisPipelineStub(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self, raise_on_error=True):
+        self.redis.commands.append("execute")
+        results = []
+        for name, args, kwargs in self.calls:
+            try:
+                results.append(getattr(self.redis, name)(*args, **kwargs))
+            except TypeError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
@@ -0,0 +1,325 @@
+# encoding: utf-8
+import unittest
+from pyslate.backends.postgres_backend import PostgresBackend
+from pyslate.backends.redis_backend import RedisBackend, RedisTagHashBackend, migrate_to_tag_hashes
+from tests.helpers import RedisStub
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401, needed by fakeredis to run Lua scripts
+except ImportError:
+    fakeredis = None
+
+
+class CursorStub(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def execute(self, query, params=None):
+        error = self.connection.errors.pop(query.split()[0], None)
+        if error is not None:
+            self.connection.queries.append((query, params))
+            raise error
+        if self.connection.closed:
+            raise IOError("connection already closed")
+        if self.connection.drop_on_query:
+            self.connection.closed = 1
+            raise IOError("server closed the connection unexpectedly")
+        self.connection.queries.append((query, params))
+        self.rows = list(self.connection.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class DatabaseErrorStub(Exception):
+
+    def __init__(self, pgcode):
+        super(DatabaseErrorStub, self).__init__(pgcode)
+        self.pgcode = pgcode
+
+
+class ConnectionStub(object):
+
+    def __init__(self, rows=(), drop_on_query=False):
+        self.rows = rows
+        self.queries = []
+        self.closed = 0
+        self.drop_on_query = drop_on_query
+        self.rollbacks = 0
+        self.errors = {}  # first word of the query => exception raised by the query
+        self.named_cursors = []
+
+    def cursor(self, name=None):
+        cursor = CursorStub(self)
+        if name is not None:
+            self.named_cursors.append(cursor)
+        return cursor
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class PoolStub(object):
+
+    def __init__(self, connections):
+        self.connections = list(connections)
+        self.borrowed = []
+        self.discarded = []
+
+    def getconn(self):
+        conn = self.connections.pop(0)
+        self.borrowed.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        self.borrowed.remove(conn)
+        if close:
+            self.discarded.append(conn)
+        else:
+            self.connections.append(conn)
+
+
+class PostgresBackendTest(unittest.TestCase):
+
+    def test_record_found_by_single_query(self):
+        conn = ConnectionStub(rows=[("kiepska", None)])
+        backend = PostgresBackend(conn, "translations", prepare_statements=False)
+
+        self.assertEqual(("kiepska", None), backend.get_record(["a_poor#fab", "a_poor#fa", "a_poor#f", "a_poor"],
+                                                               ("pl", "de", "en")))
+        self.assertEqual(1, len(conn.queries))
+        query, params = conn.queries[0]
+        self.assertIn("LIMIT 1", query)
+        self.assertEqual((["pl", "de", "en"], ["a_poor#fab", "a_poor#fa", "a_poor#f", "a_poor"]), params)
+
+    def test_missing_record(self):
+        conn = ConnectionStub()
+        backend = PostgresBackend(conn, "translations", prepare_statements=False)
+
+        self.assertIsNone(backend.get_content(["missing#p", "missing"], ["pl", "en"]))
+        self.assertEqual(1, len(conn.queries))
+
+    def test_connection_borrowed_from_pool(self):
+        first_conn = ConnectionStub(rows=[("miecz", None)])
+        second_conn = ConnectionStub(rows=[("miecz", None)])
+        pool = PoolStub([first_conn, second_conn])
+        backend = PostgresBackend(pool, "translations")
+
+        self.assertEqual("miecz", backend.get_content(["entity_sword"], ["pl"]))
+        self.assertEqual("miecz", backend.get_content(["entity_sword"], ["pl"]))
+        self.assertEqual([], pool.borrowed)
+        self.assertEqual(2, len(first_conn.queries))  # statement is prepared on each connection
+        self.assertEqual(2, len(second_conn.queries))
+
+    def test_dropped_connection_replaced(self):
+        dropped_conn = ConnectionStub(drop_on_query=True)
+        working_conn = ConnectionStub(rows=[("miecz", None)])
+        pool = PoolStub([dropped_conn, working_conn])
+        backend = PostgresBackend(pool, "translations")
+
+        self.assertEqual("miecz", backend.get_content(["entity_sword"], ["pl"]))
+        self.assertEqual([dropped_conn], pool.discarded)
+        self.assertEqual([working_conn], pool.connections)
+
+    def test_failed_query_rolled_back(self):
+        conn = ConnectionStub(rows=[1])  # row is not a tuple, so fetching fails
+        backend = PostgresBackend(conn, "translations", changes_table_name="translations_changes")
+
+        self.assertRaises(TypeError, backend.get_changed_tags, 1)
+        self.assertEqual(1, conn.rollbacks)
+
+    def test_statement_prepared_once_per_connection(self):
+        conn = ConnectionStub(rows=[("miecz", None)])
+        backend = PostgresBackend(conn, "public.translations")
+
+        for i in range(3):
+            self.assertEqual(("miecz", None), backend.get_record(["entity_sword"], ["pl", "en"]))
+        queries = [query for query, params in conn.queries]
+        self.assertEqual(4, len(queries))
+        statement_name = queries[0].split()[1]
+        self.assertTrue(statement_name.startswith("pyslate_get_record_"))
+        self.assertTrue(statement_name.endswith("_public_translations"))
+        self.assertTrue(queries[0].startswith("PREPARE " + statement_name + " (text[], text[]) AS"))
+        self.assertIn("unnest($1::text[])", queries[0])
+        self.assertEqual(["EXECUTE " + statement_name + " (%s, %s)"] * 3, queries[1:])
+        self.assertEqual((["pl", "en"], ["entity_sword"]), conn.queries[1][1])
+
+    def test_statement_names_of_similar_tables_differ(self):
+        statement_names = []
+        for table_name in ["public.tags", "public_tags"]:
+            conn = ConnectionStub(rows=[("miecz", None)])
+            PostgresBackend(conn, table_name).get_record(["entity_sword"], ["pl"])
+            statement_names.append(conn.queries[0][0].split()[1])
+        self.assertNotEqual(statement_names[0], statement_names[1])
+
+    def test_statement_prepared_again(self):
+        conn = ConnectionStub(rows=[("miecz", None)])
+        backend = PostgresBackend(conn, "translations")
+        backend.get_record(["entity_sword"], ["pl"])
+
+        conn.errors = {"EXECUTE": DatabaseErrorStub("26000")}  # session was reset
+        self.assertEqual(("miecz", None), backend.get_record(["entity_sword"], ["pl"]))
+        self.assertEqual(["PREPARE", "EXECUTE", "EXECUTE", "PREPARE", "EXECUTE"],
+                         [query.split()[0] for query, params in conn.queries])
+        self.assertEqual(1, conn.rollbacks)
+
+    def test_statement_already_prepared(self):
+        conn = ConnectionStub(rows=[("miecz", None)])
+        conn.errors = {"PREPARE": DatabaseErrorStub("42P05")}
+        backend = PostgresBackend(conn, "translations")
+
+        self.assertEqual(("miecz", None), backend.get_record(["entity_sword"], ["pl"]))
+        self.assertEqual(("miecz", None), backend.get_record(["entity_sword"], ["pl"]))
+        self.assertEqual(["PREPARE", "EXECUTE", "EXECUTE"], [query.split()[0] for query, params in conn.queries])
+
+    def test_export_records(self):
+        rows = [("hello", "en", "Hello", None), ("hello", "pl", "Witaj", None), ("judy", "en", "Judy", "f")]
+        conn = ConnectionStub(rows=rows)
+        pool = PoolStub([conn])
+        backend = PostgresBackend(pool, "translations")
+
+        exported = backend.export_records(["en", "pl"], prefix="h_%", batch_size=2)
+        self.assertEqual(rows[0], next(exported))
+        self.assertEqual([conn], pool.borrowed)
+        self.assertEqual(rows[1:], list(exported))
+        self.assertEqual([], pool.borrowed)
+
+        self.assertEqual(2, conn.named_cursors[0].itersize)
+        query, params = conn.queries[0]
+        self.assertIn("name LIKE %s", query)
+        self.assertEqual([["en", "pl"], "h\\_\\%%"], params)
+
+    def test_get_all_records(self):
+        rows = [("hello", "en", "Hello", None), ("hello", "pl", "Witaj", None), ("judy", "en", "Judy", "f")]
+        backend = PostgresBackend(ConnectionStub(rows=rows), "translations")
+
+        self.assertEqual({"hello": {"en": ("Hello", None), "pl": ("Witaj", None)}, "judy": {"en": ("Judy", "f")}},
+                         backend.get_all_records(["en", "pl"]))
+
+
+KEY_PER_LANGUAGE_HASHES = {
+    "pyslate_hello:en": {"content": "Hello"},
+    "pyslate_hello:pl": {"content": u"Cześć"},
+    "pyslate_a_poor:pl": {"content": "kiepski", "form": "m"},
+    "pyslate_a_poor#f:pl": {"content": "kiepska"},
+    "pyslate_judy:en": {"content": "Judy", "form": "f"},
+}
+
+
+class RedisBackendTest(unittest.TestCase):
+
+    def test_get_record(self):
+        backend = RedisBackend(RedisStub(KEY_PER_LANGUAGE_HASHES))
+
+        self.assertEqual(["kiepska", None], backend.get_record(["a_poor#fm", "a_poor#f", "a_poor"], ["pl", "en"]))
+        self.assertEqual(["Judy", "f"], backend.get_record(["judy"], ["pl", "en"]))
+        self.assertIsNone(backend.get_record(["missing"], ["pl", "en"]))
+
+    def test_get_all_records(self):
+        redis = RedisStub(KEY_PER_LANGUAGE_HASHES)
+        redis.strings["pyslate_version"] = b"3"
+        backend = RedisBackend(redis)
+
+        self.assertEqual({"hello": {"pl": (u"Cześć", None)}, "a_poor": {"pl": ("kiepski", "m")},
+                          "a_poor#f": {"pl": ("kiepska", None)}}, backend.get_all_records(["pl"]))
+        self.assertEqual({"a_poor": {"pl": ("kiepski", "m")}, "a_poor#f": {"pl": ("kiepska", None)}},
+                         backend.get_all_records(["pl", "de"], prefix="a_"))
+        self.assertEqual(3, backend.get_version())
+
+    def test_get_changed_tags(self):
+        redis = RedisStub()
+        redis.strings["pyslate_version"] = b"5"
+        redis.sorted_sets["pyslate_changes"] = {"3:hello": 3, "4:judy": 4, "4:a_poor": 4, "5:": 5, "5:judy": 5,
+                                                "6:hello": 6}  # version 6 isn't incremented yet
+        backend = RedisBackend(redis)
+
+        self.assertEqual({"judy"}, backend.get_changed_tags(4))
+        self.assertEqual({"hello", "judy", "a_poor"}, backend.get_changed_tags(2))
+        self.assertEqual(set(), backend.get_changed_tags(5))
+        self.assertIsNone(backend.get_changed_tags(1))  # changes of version 2 aren't recorded
+        self.assertIsNone(backend.get_changed_tags(6))
+
+        redis.strings["pyslate_version"] = b"7"  # version bumped without recording the changes
+        self.assertIsNone(backend.get_changed_tags(5))
+
+        del redis.sorted_sets["pyslate_changes"]["4:judy"]
+        del redis.sorted_sets["pyslate_changes"]["4:a_poor"]  # changes of version 4 removed in the middle
+        redis.strings["pyslate_version"] = b"5"
+        self.assertIsNone(backend.get_changed_tags(3))
+
+    def test_changes_not_recorded(self):
+        redis = RedisStub()
+        redis.strings["pyslate_version"] = b"2"
+        self.assertIsNone(RedisBackend(redis).get_changed_tags(1))
+
+
+class RedisTagHashBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = RedisStub(KEY_PER_LANGUAGE_HASHES)
+        self.redis.strings["pyslate_version"] = b"3"
+        self.redis.sorted_sets["pyslate_changes"] = {"2:hello": 2, "3:judy": 3}
+        self.assertEqual(5, migrate_to_tag_hashes(self.redis, remove_old_keys=True))
+
+    def test_migrated(self):
+        self.assertEqual({
+            "pyslate_hello": {"content:en": "Hello", "content:pl": u"Cześć"},
+            "pyslate_a_poor": {"content:pl": "kiepski", "form:pl": "m"},
+            "pyslate_a_poor#f": {"content:pl": "kiepska"},
+            "pyslate_judy": {"content:en": "Judy", "form:en": "f"},
+        }, self.redis.hashes)
+        self.assertEqual(b"3", self.redis.strings["pyslate_:version"])
+        self.assertEqual({"2:hello": 2, "3:judy": 3}, self.redis.sorted_sets["pyslate_:changes"])
+        self.assertEqual(3, RedisTagHashBackend(self.redis).get_version())
+        self.assertEqual({"judy"}, RedisTagHashBackend(self.redis).get_changed_tags(2))
+
+    def test_get_record(self):
+        backend = RedisTagHashBackend(self.redis)
+        self.redis.commands = []
+        self.assertEqual(["kiepska", None], backend.get_record(["a_poor#fm", "a_poor#f", "a_poor"], ["pl", "en"]))
+        self.assertEqual(["Judy", "f"], backend.get_record(["judy"], ["pl", "en"]))
+        self.assertEqual([u"Cześć", None], backend.get_record(["hello"], ["pl", "en"]))
+        self.assertIsNone(backend.get_record(["missing"], ["pl", "en"]))
+        self.assertEqual(4, self.redis.commands.count("execute"))
+
+    def test_get_all_records(self):
+        backend = RedisTagHashBackend(self.redis)
+
+        self.assertEqual({"hello": {"en": ("Hello", None)}, "judy": {"en": ("Judy", "f")}},
+                         backend.get_all_records(["en"]))
+        self.assertEqual({"a_poor": {"pl": ("kiepski", "m")}, "a_poor#f": {"pl": ("kiepska", None)}},
+                         backend.get_all_records(["pl", "de"], prefix="a_"))
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis with Lua support is not installed")
+class RedisTagHashBackendScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        for key, value in KEY_PER_LANGUAGE_HASHES.items():
+            self.redis.hset(key, mapping=value)
+        migrate_to_tag_hashes(self.redis, remove_old_keys=True)
+
+    def test_get_record(self):
+        backend = RedisTagHashBackend(self.redis, use_script=True)
+
+        self.assertEqual(["kiepska", None], backend.get_record(["a_poor#fm", "a_poor#f", "a_poor"], ["pl", "en"]))
+        self.assertEqual(["kiepski", "m"], backend.get_record(["a_poor#m", "a_poor"], ["en", "pl"]))
+        self.assertEqual(["Judy", "f"], backend.get_record(["judy"], ["pl", "en"]))
+        self.assertEqual([u"Cześć", None], backend.get_record(["hello"], ["pl", "en"]))
+        self.assertIsNone(backend.get_record(["missing"], ["pl", "en"]))
@@ -0,0 +1,545 @@
+# encoding: utf-8
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pyslate.backends.json_backend import JsonBackend
+from pyslate.backends.redis_backend import RedisBackend
+from tests.helpers import FakeTimer, RedisStub
+from pyslate.cache import LRUCache, SimpleMemoryCache, BoundedMemoryCache, TwoTierCache, VersionedCache, \
+    RevalidatingCache, SingleFlight
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(max_size=2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual("default", cache.get("a", "default"))
+
+        cache.set("a", "A")
+        cache.set("b", "B")
+        self.assertEqual("A", cache.get("a"))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        cache.get("a")
+        cache.set("c", "C")
+
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual("A", cache.get("a"))
+        self.assertEqual("C", cache.get("c"))
+
+    def test_zero_size(self):
+        cache = LRUCache(max_size=0)
+        cache.set("a", "A")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+    def test_ttl(self):
+        timer = FakeTimer()
+        cache = LRUCache(ttl=10, timer=timer)
+        cache.set("a", "A")
+        timer.now += 9
+        self.assertEqual("A", cache.get("a"))
+        timer.now += 1
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+    def test_clear(self):
+        cache = LRUCache()
+        cache.set("a", "A")
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+
+
+class SimpleMemoryCacheTest(unittest.TestCase):
+
+    def test_remove(self):
+        cache = SimpleMemoryCache()
+        cache.save("hello", "en", "Hello", None)
+        cache.save("hello", "pl", "Witaj", None)
+        cache.save("sword", "pl", "miecz", "m")
+        cache.remove("hello")
+
+        self.assertIsNone(cache.load("hello", "en"))
+        self.assertIsNone(cache.load("hello", "pl"))
+        self.assertEqual(("miecz", "m"), cache.load("sword", "pl"))
+
+
+class BoundedMemoryCacheTest(unittest.TestCase):
+
+    def test_save_and_load(self):
+        cache = BoundedMemoryCache()
+        self.assertIsNone(cache.load("sword", "pl"))
+        cache.save("sword", "pl", "miecz", "m")
+        cache.save("wand", "pl", "różdżka", None)
+
+        self.assertEqual(("miecz", "m"), cache.load("sword", "pl"))
+        self.assertEqual(("różdżka", None), cache.load("wand", "pl"))
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+    def test_lru_eviction(self):
+        cache = BoundedMemoryCache(max_entries=2)
+        cache.save("a", "en", "A", None)
+        cache.save("b", "en", "B", None)
+        cache.load("a", "en")
+        cache.save("c", "en", "C", None)
+
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        self.assertIsNone(cache.load("b", "en"))
+        self.assertEqual(("A", None), cache.load("a", "en"))
+
+    def test_lfu_eviction(self):
+        cache = BoundedMemoryCache(max_entries=2, policy="lfu")
+        cache.save("a", "en", "A", None)
+        cache.save("b", "en", "B", None)
+        for i in range(3):
+            cache.load("a", "en")
+        cache.load("b", "en")
+        cache.save("c", "en", "C", None)  # "b" is used less frequently than "a"
+        cache.save("d", "en", "D", None)  # "c" was used only once
+
+        self.assertEqual(("A", None), cache.load("a", "en"))
+        self.assertIsNone(cache.load("b", "en"))
+        self.assertIsNone(cache.load("c", "en"))
+        self.assertEqual(("D", None), cache.load("d", "en"))
+
+    def test_max_bytes(self):
+        cache = BoundedMemoryCache(max_bytes=300)
+        cache.save("a", "en", "A" * 100, None)
+        cache.save("b", "en", "B" * 100, None)
+        self.assertIsNone(cache.load("a", "en"))
+        self.assertLessEqual(cache.size_bytes, 300)
+
+        cache.save("c", "en", "C" * 1000, None)  # too big to be cached at all
+        self.assertIsNone(cache.load("c", "en"))
+        self.assertEqual(("B" * 100, None), cache.load("b", "en"))
+
+        cache.save("b", "en", "B" * 1000, None)  # previous value of the record isn't served anymore
+        self.assertIsNone(cache.load("b", "en"))
+        self.assertEqual(0, cache.size_bytes)
+
+    def test_zero_entries(self):
+        cache = BoundedMemoryCache(max_entries=0)
+        cache.save("a", "en", "A", None)
+        self.assertIsNone(cache.load("a", "en"))
+        self.assertEqual(0, len(cache))
+
+    def test_remove_and_clear_language(self):
+        for policy in ["lru", "lfu"]:
+            cache = BoundedMemoryCache(policy=policy)
+            for tag_name in ["a", "b"]:
+                for language in ["en", "pl"]:
+                    cache.save(tag_name, language, tag_name + language, None)
+
+            cache.remove("a")
+            self.assertIsNone(cache.load("a", "en"))
+            self.assertIsNone(cache.load("a", "pl"))
+
+            cache.clear(language="pl")
+            self.assertIsNone(cache.load("b", "pl"))
+            self.assertEqual(("ben", None), cache.load("b", "en"))
+
+            cache.clear()
+            self.assertEqual(0, len(cache))
+            self.assertEqual(0, cache.size_bytes)
+
+    def test_ttl(self):
+        timer = FakeTimer()
+        cache = BoundedMemoryCache(ttl=100, missing_ttl=10, timer=timer)
+        cache.save("sword", "pl", "miecz", "m")
+        cache.save("unknown", "pl", None, None)
+
+        timer.now += 9
+        self.assertEqual((None, None), cache.load("unknown", "pl"))
+        timer.now += 1
+        self.assertIsNone(cache.load("unknown", "pl"))
+        self.assertEqual(("miecz", "m"), cache.load("sword", "pl"))
+
+        timer.now += 90
+        self.assertIsNone(cache.load("sword", "pl"))
+        self.assertEqual(0, len(cache))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            BoundedMemoryCache(policy="random")
+
+
+class TwoTierCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = RedisStub()
+        self.cache = TwoTierCache(self.redis, ttl=3600)
+
+    def test_saved_in_both_tiers(self):
+        self.cache.save("judy", "en", "Policewoman Judy", "f")
+
+        self.assertEqual(("Policewoman Judy", "f"), self.cache.l1_cache.load("judy", "en"))
+        self.assertEqual({"en": '["Policewoman Judy","f"]'}, self.redis.hashes["pyslate_cache_judy"])
+        self.assertEqual(3600, self.redis.expirations["pyslate_cache_judy"])
+
+    def test_l1_hit_doesnt_use_l2(self):
+        self.cache.save("judy", "en", "Policewoman Judy", "f")
+        self.redis.commands = []
+
+        self.assertEqual(("Policewoman Judy", "f"), self.cache.load("judy", "en"))
+        self.assertEqual([], self.redis.commands)
+
+    def test_l2_hit_written_back_to_l1(self):
+        other_process_cache = TwoTierCache(self.redis)
+        other_process_cache.save("welcome", "pl", u"Witaj świecie!", None)
+
+        self.assertEqual((u"Witaj świecie!", None), self.cache.load("welcome", "pl"))
+        self.assertEqual((u"Witaj świecie!", None), self.cache.l1_cache.load("welcome", "pl"))
+        self.assertEqual(1, self.cache.l2_hits)
+        self.assertIsNone(self.cache.load("welcome", "en"))
+        self.assertEqual(1, self.cache.l2_misses)
+
+    def test_missing_tag_only_in_l1(self):
+        self.cache.save("missing", "en", None, None)
+
+        self.assertEqual((None, None), self.cache.load("missing", "en"))
+        self.assertEqual({}, self.redis.hashes)
+
+    def test_l2_unreachable(self):
+        self.redis.reachable = False
+        self.cache.save("judy", "en", "Policewoman Judy", "f")
+
+        self.assertEqual(("Policewoman Judy", "f"), self.cache.load("judy", "en"))
+        self.assertIsNone(self.cache.load("hello", "en"))
+        self.cache.remove("judy")
+        self.cache.clear()
+        self.assertEqual(1, self.cache.l2_errors)  # L2 isn't tried again until retry_interval passes
+        self.assertIsNone(self.cache.load("judy", "en"))
+
+    def test_l2_retried_after_interval(self):
+        timer = FakeTimer()
+        self.cache = TwoTierCache(self.redis, retry_interval=5, timer=timer)
+        self.redis.hashes["pyslate_cache_hello"] = {"en": '["Hello",null]'}
+        self.redis.reachable = False
+        self.assertIsNone(self.cache.load("hello", "en"))
+
+        self.redis.reachable = True
+        timer.now += 4
+        self.assertIsNone(self.cache.load("hello", "en"))
+        timer.now += 1
+        self.assertEqual(("Hello", None), self.cache.load("hello", "en"))
+        self.assertEqual(1, self.cache.l2_errors)
+
+    def test_remove_and_clear(self):
+        self.redis.hashes["other_key"] = {"en": "[]"}
+        self.cache.save("judy", "en", "Policewoman Judy", "f")
+        self.cache.save("judy", "pl", "Policjantka Judy", "f")
+        self.cache.save("hello", "en", "Hello", None)
+
+        self.cache.remove("judy")
+        self.assertIsNone(self.cache.load("judy", "pl"))
+        self.assertEqual(["other_key", "pyslate_cache_hello"], sorted(self.redis.hashes))
+
+        self.cache.clear()
+        self.assertIsNone(self.cache.load("hello", "en"))
+        self.assertEqual(["other_key"], sorted(self.redis.hashes))
+
+
+class VersionedBackendStub(object):
+
+    def __init__(self, changes=None):
+        self.version = 1
+        self.changes = changes  # version -> names of tags changed in this version
+
+    def get_version(self):
+        return self.version
+
+    def change(self, *tag_names):
+        self.version += 1
+        if self.changes is not None:
+            self.changes[self.version] = set(tag_names)
+
+
+class VersionedBackendWithChangesStub(VersionedBackendStub):
+
+    def get_changed_tags(self, version):
+        return set(tag_name for changed_version, tag_names in self.changes.items() if changed_version > version
+                   for tag_name in tag_names)
+
+
+class VersionedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+
+    def create_cache(self, backend):
+        cache = VersionedCache(SimpleMemoryCache(), backend, check_interval=10, timer=self.timer)
+        cache.save("hello", "en", "Hello", None)
+        cache.save("hello", "pl", "Witaj", None)
+        cache.save("entity_sword#p", "en", "swords", None)
+        cache.save("judy", "en", "Judy", "f")
+        return cache
+
+    def test_version_checked_after_interval(self):
+        backend = VersionedBackendStub()
+        cache = self.create_cache(backend)
+        backend.change("hello")
+
+        self.timer.now += 5
+        self.assertEqual(("Hello", None), cache.load("hello", "en"))
+        self.assertEqual(0, cache.generation)
+
+        self.timer.now += 5
+        self.assertIsNone(cache.load("hello", "en"))
+        self.assertEqual(1, cache.generation)
+        self.assertEqual(2, cache.catalog_version)
+
+    def test_all_invalidated_without_changed_tags(self):
+        backend = VersionedBackendStub()
+        cache = self.create_cache(backend)
+        backend.change("hello")
+
+        self.timer.now += 10
+        self.assertIsNone(cache.load("judy", "en"))
+
+    def test_changed_tags_and_their_variants_invalidated(self):
+        backend = VersionedBackendWithChangesStub(changes={})
+        cache = self.create_cache(backend)
+        backend.change("hello")
+        backend.change("entity_sword")
+
+        self.timer.now += 10
+        self.assertEqual(1, cache.check_version())
+        self.assertIsNone(cache.load("hello", "en"))
+        self.assertIsNone(cache.load("hello", "pl"))
+        self.assertIsNone(cache.load("entity_sword#p", "en"))
+        self.assertEqual(("Judy", "f"), cache.load("judy", "en"))
+
+    def test_number_of_tracked_tags_limited(self):
+        cache = VersionedCache(SimpleMemoryCache(), VersionedBackendStub(), timer=self.timer, max_tracked_tags=2)
+        cache.save("hello", "en", "Hello", None)
+        cache.save("entity_sword#p", "en", "swords", None)
+        cache.save("entity_sword", "en", "sword", None)
+        cache.save("judy", "en", "Judy", "f")
+
+        self.assertEqual(["entity_sword", "judy"], list(cache._variants_by_tag))
+        self.assertIsNone(cache.load("hello", "en"))  # it couldn't be invalidated anymore
+        self.assertEqual(("swords", None), cache.load("entity_sword#p", "en"))
+
+    def test_version_checked_through_wrapper(self):
+        backend = VersionedBackendStub()
+        cache = RevalidatingCache(self.create_cache(backend), timer=self.timer)
+        two_tier_cache = TwoTierCache(RedisStub(), l1_cache=self.create_cache(backend))
+        backend.change("hello")
+
+        self.timer.now += 10
+        self.assertEqual(1, cache.check_version())
+        self.assertEqual(1, two_tier_cache.check_version())
+        self.assertIsNone(RevalidatingCache(SimpleMemoryCache()).check_version())
+
+    def test_all_invalidated_without_recorded_changes(self):
+        redis = RedisStub()
+        redis.strings["pyslate_version"] = b"1"
+        redis.sorted_sets["pyslate_changes"] = {"1:hello": 1}
+        cache = self.create_cache(RedisBackend(redis))
+        redis.strings["pyslate_version"] = b"2"
+
+        self.timer.now += 10
+        self.assertEqual(1, cache.check_version())
+        self.assertIsNone(cache.load("judy", "en"))
+
+    def test_unchanged_version(self):
+        cache = self.create_cache(VersionedBackendStub())
+
+        self.timer.now += 100
+        self.assertEqual(("Judy", "f"), cache.load("judy", "en"))
+        self.assertEqual(0, cache.generation)
+
+
+class JsonBackendVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        file_descriptor, self.file_name = tempfile.mkstemp(suffix=".json")
+        os.close(file_descriptor)
+        self.write_tags({"hello": {"en": "Hello"}, "judy": {"en": ["Judy", "f"]}}, mtime=1000)
+        self.backend = JsonBackend(self.file_name)
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def write_tags(self, tags, mtime):
+        with open(self.file_name, "w") as file:
+            file.write(json.dumps(tags))
+        os.utime(self.file_name, (mtime, mtime))
+
+    def test_reloaded_when_file_changes(self):
+        self.assertEqual(1000, self.backend.get_version())
+        self.assertEqual(set(), self.backend.get_changed_tags(1000))
+
+        self.write_tags({"hello": {"en": "Hi"}, "judy": {"en": ["Judy", "f"]}, "new": {"en": "New"}}, mtime=2000)
+        self.assertEqual(2000, self.backend.get_version())
+        self.assertEqual(("Hi", None), self.backend.get_record(["hello"], ["en"]))
+        self.assertEqual({"hello", "new"}, self.backend.get_changed_tags(1000))
+        self.assertIsNone(self.backend.get_changed_tags(500))
+
+    def test_no_version_without_file(self):
+        self.assertIsNone(JsonBackend(json_data={"hello": {"en": "Hello"}}).get_version())
+
+
+class ExecutorStub(object):
+    """Collects submitted functions, so the test decides when they are run"""
+
+    def __init__(self):
+        self.functions = []
+
+    def submit(self, function):
+        self.functions.append(function)
+
+    def run_all(self):
+        functions, self.functions = self.functions, []
+        for function in functions:
+            function()
+
+
+class RevalidatingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.executor = ExecutorStub()
+        self.cache = RevalidatingCache(SimpleMemoryCache(), soft_ttl=10, hard_ttl=100,
+                                       executor=self.executor, timer=self.timer)
+        self.cache.save("hello", "en", "Hello", None)
+
+    def test_fresh_record_not_refreshed(self):
+        self.timer.now += 5
+        self.assertEqual(("Hello", None), self.cache.load_with_refresh("hello", "en", lambda: ("Hi", None)))
+        self.assertEqual([], self.executor.functions)
+
+    def test_stale_record_returned_and_refreshed(self):
+        self.timer.now += 20
+        self.assertEqual(("Hello", None), self.cache.load_with_refresh("hello", "en", lambda: ("Hi", None)))
+        self.assertEqual(("Hello", None), self.cache.load_with_refresh("hello", "en", lambda: ("Hi", None)))
+        self.assertEqual(1, len(self.executor.functions))  # record is refreshed once at a time
+
+        self.executor.run_all()
+        self.assertEqual(("Hi", None), self.cache.load_with_refresh("hello", "en", lambda: ("Hi", None)))
+        self.assertEqual([], self.executor.functions)
+        self.assertEqual(1, self.cache.refreshes)
+
+    def test_record_dropped_after_hard_ttl(self):
+        self.timer.now += 100
+        self.assertIsNone(self.cache.load_with_refresh("hello", "en", lambda: ("Hi", None)))
+        self.assertIsNone(self.cache.load("hello", "en"))
+
+    def test_failed_refresh(self):
+        def refresh():
+            raise IOError("backend unavailable")
+
+        self.timer.now += 20
+        self.cache.load_with_refresh("hello", "en", refresh)
+        self.executor.run_all()
+        self.assertEqual(1, self.cache.refresh_errors)
+        self.assertEqual(("Hello", None), self.cache.load_with_refresh("hello", "en", refresh))
+        self.assertEqual(1, len(self.executor.functions))  # next try
+
+    def test_removed_tag(self):
+        self.timer.now += 20
+        self.cache.load_with_refresh("hello", "en", lambda: (None, None))
+        self.executor.run_all()
+        self.assertIsNone(self.cache.load("hello", "en"))
+
+    def test_record_saved_in_wrapped_cache_refreshed(self):  # e.g. saved in a shared cache by another process
+        self.cache.cache.save("judy", "en", "Judy", "f")
+
+        self.assertEqual(("Judy", "f"), self.cache.load_with_refresh("judy", "en", lambda: ("Judy", "f")))
+        self.assertEqual(1, len(self.executor.functions))
+        self.executor.run_all()
+        self.assertEqual(("Judy", "f"), self.cache.load_with_refresh("judy", "en", lambda: ("Judy", "f")))
+        self.assertEqual([], self.executor.functions)
+
+    def test_number_of_tracked_tags_limited(self):
+        cache = RevalidatingCache(SimpleMemoryCache(), soft_ttl=10, executor=self.executor, timer=self.timer,
+                                  max_tracked_tags=2)
+        cache.save("hello", "en", "Hello", None)
+        cache.save("hello", "pl", "Witaj", None)
+        cache.save("judy", "en", "Judy", "f")
+        cache.save("welcome", "en", "Welcome", None)
+
+        self.assertEqual(["judy", "welcome"], list(cache._saved_at))
+        self.assertEqual(("Hello", None), cache.load_with_refresh("hello", "en", lambda: ("Hello", None)))
+        self.assertEqual(1, len(self.executor.functions))  # age of the forgotten record is unknown
+
+    def test_refreshed_in_thread(self):
+        cache = RevalidatingCache(SimpleMemoryCache(), soft_ttl=0)
+        cache.save("hello", "en", "Hello", None)
+        refreshed = threading.Event()
+
+        def refresh():
+            refreshed.set()
+            return "Hi", None
+
+        self.assertEqual(("Hello", None), cache.load_with_refresh("hello", "en", refresh))
+        self.assertTrue(refreshed.wait(5))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_concurrently(self, single_flight, function, threads_count=5):
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def leader_function():
+            started.set()
+            release.wait(5)
+            return function()
+
+        def call():
+            try:
+                results.append(single_flight.do("key", leader_function))
+            except IOError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(threads_count)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        deadline = time.time() + 5
+        while single_flight.coalesced < threads_count - 1:
+            if time.time() > deadline:
+                release.set()  # waiting threads are let go, so they don't hang
+                self.fail("calls were not coalesced in time")
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_function_run_once(self):
+        calls = []
+        single_flight = SingleFlight()
+        results = self.run_concurrently(single_flight, lambda: calls.append(1) or "result")
+
+        self.assertEqual(["result"] * 5, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(4, single_flight.coalesced)
+
+    def test_exception_passed_to_all_callers(self):
+        def function():
+            raise IOError("backend unavailable")
+
+        results = self.run_concurrently(SingleFlight(), function)
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(isinstance(result, IOError) for result in results))
+
+    def test_sequential_calls_not_coalesced(self):
+        single_flight = SingleFlight()
+        self.assertEqual(1, single_flight.do("key", lambda: 1))
+        self.assertEqual(2, single_flight.do("key", lambda: 2))
+        self.assertEqual(0, single_flight.coalesced)
@@ -1,7 +1,9 @@
 # encoding: utf-8
 
+import threading
 import unittest
-from pyslate.parser import PyLexer, PyParser, InnerTagField, VariableField, SwitchField, PyslateException
+from pyslate.parser import PyLexer, PyParser, FastParser, CachingParser, is_plaintext, split_tag_key, \
+    InnerTagField, VariableField, SwitchField, PyslateException
 
 
 class LexerTest(unittest.TestCase):
@@ -86,6 +88,14 @@ class LexerTest(unittest.TestCase):
         tokens = self.tokenize_to_list("")
         self.assertListEqual([], tokens)
 
+    def test_lexers_are_independent(self):  # lexers share tables, but their state is separate
+        other_lexer = PyLexer()
+        other_lexer.build()
+        other_lexer.tokenize("%{a")
+
+        self.assertListEqual([("PLAINTEXT", ":")], self.tokenize_to_list(":"))
+
+
 class ParserTest(unittest.TestCase):
 
     def setUp(self):
@@ -143,3 +153,161 @@ class ParserTest(unittest.TestCase):
         result = self.parser.parse("Kupił%{gen:m?em|f?am} kosiarkę.")
 
         self.assertEqual(["Kupił", SwitchField({"m": "em", "f": "am"}, "m", tag_id="gen"), " kosiarkę."], result)
+
+
+class PyParserTablesTest(unittest.TestCase):
+
+    def test_tables_built_lazily_and_shared(self):
+        first_parser, second_parser = PyParser(), PyParser()
+        self.assertIsNone(first_parser.parser)
+
+        self.assertEqual([VariableField("a")], first_parser.parse("%{a}"))
+        self.assertEqual([InnerTagField(["a"])], second_parser.parse("${a}"))
+        self.assertIs(first_parser.parser, second_parser.parser)
+
+
+    def test_invalid_input_doesnt_affect_next_parse(self):
+        parser = PyParser()
+        with self.assertRaises(PyslateException):
+            parser.parse("%{")
+        self.assertEqual(["a:b}"], parser.parse("a:b}"))
+
+
+class ThreadSafetyTest(unittest.TestCase):
+
+    TEXTS = ["You see ${giver:char_info} give ${entity_%{item_name}#u} to ${taker:char_info}.",
+             "Kupił%{gen:m?em|f?am} kosiarkę.", "a:b|c?d@e}", "${a%{b@c}d@e@f}"]
+
+    def assert_same_results_in_threads(self, parser):
+        expected_results = [list(FastParser().parse(text)) for text in self.TEXTS]
+        errors = []
+
+        def parse_many_times(thread_number):
+            try:
+                for i in range(300):
+                    text_index = (thread_number + i) % len(self.TEXTS)
+                    if list(parser.parse(self.TEXTS[text_index])) != expected_results[text_index]:
+                        errors.append(self.TEXTS[text_index])
+                    with self.assertRaises(PyslateException):
+                        parser.parse("%{a?b")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=parse_many_times, args=(thread_number,)) for thread_number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+    def test_shared_ply_parser(self):
+        self.assert_same_results_in_threads(PyParser())
+
+    def test_shared_caching_parser(self):
+        self.assert_same_results_in_threads(CachingParser(PyParser(), max_size=2))
+
+
+class FastParserTest(ParserTest):  # FastParser must produce exactly the same results as PyParser
+
+    def setUp(self):
+        self.parser = FastParser()
+
+    def test_same_as_ply_parser(self):
+        ply_parser = PyParser()
+        for text in ["", "$", "%", "50% off", "$$${a}", "a:b|c?d@e}", "%{a?|b?c|a?d}", "${a%{b@c}d@e@f}",
+                     "${id:a%{x:m?y|f?z}#u@upper}", "\\\\a\\${b}", "%{name@article@capitalize}"]:
+            self.assertEqual(ply_parser.parse(text), self.parser.parse(text))
+
+        for text in ["${", "%{a:b}", "${a:b:c}", "${}", "${a@}", "%{?a}", "$:", "%{a?b?c}", "%{a@b?c}"]:
+            with self.assertRaises(PyslateException):
+                self.parser.parse(text)
+
+
+class CachingParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = CachingParser(PyParser(), max_size=2)
+
+    def test_cache_hits(self):
+        first_result = self.parser.parse("${a} %{b@upper}")
+        self.assertIs(first_result, self.parser.parse("${a} %{b@upper}"))
+        self.assertEqual((1, 1), (self.parser.hits, self.parser.misses))
+
+        self.parser.parse("a")
+        self.parser.parse("${a} %{b@upper}")  # makes "a" the least recently used result
+        self.parser.parse("b")
+        self.assertEqual(2, len(self.parser))
+        self.assertIs(first_result, self.parser.parse("${a} %{b@upper}"))
+        self.assertEqual((3, 3), (self.parser.hits, self.parser.misses))
+
+        self.parser.clear()
+        self.assertEqual(0, len(self.parser))
+        self.assertIsNot(first_result, self.parser.parse("${a} %{b@upper}"))
+
+    def test_zero_size(self):
+        parser = CachingParser(PyParser(), max_size=0)
+        self.assertEqual(parser.parse("${a}"), parser.parse("${a}"))
+        self.assertEqual(0, len(parser))
+        self.assertEqual((0, 2), (parser.hits, parser.misses))
+
+    def test_cached_result_is_frozen(self):
+        result = self.parser.parse("${a@upper}%{b:x?y}")
+        with self.assertRaises(AttributeError):
+            result[0].contents.append("b")
+        with self.assertRaises(AttributeError):
+            result[0].decorators.append("lower")
+        with self.assertRaises(TypeError):
+            result[1].cases["z"] = "z"
+        self.assertEqual([InnerTagField(["a"], decorators=["upper"]), SwitchField({"x": "y"}, "x", tag_id="b")],
+                         list(self.parser.parse("${a@upper}%{b:x?y}")))
+
+
+class PlaintextTest(unittest.TestCase):
+
+    def test_is_plaintext(self):
+        parser = FastParser()
+        for text in ["", "aaa", "help {me} hehe", "50% off", "it costs $5", "a:b|c?d@e}", "$", "%"]:
+            self.assertTrue(is_plaintext(text))
+            self.assertEqual([text] if text else [], parser.parse(text))
+
+        for text in ["${a}", "%{a}", "\\a", "aaa $}", "%@", "50%?"]:
+            self.assertFalse(is_plaintext(text))
+
+
+class SplitTagKeyTest(unittest.TestCase):
+
+    def test_simple_keys(self):
+        self.assertEqual(("hello_world", ()), split_tag_key("hello_world"))
+        self.assertEqual(("entity_sword#p", ("upper", "article")), split_tag_key("entity_sword#p@upper@article"))
+
+    def test_keys_needing_parser(self):
+        for tag_key in ["entity_%{item}", "giver:char_info", "a@", "@a", "a@@b", "", "a}"]:
+            self.assertIsNone(split_tag_key(tag_key))
+
+
+class NodeTest(unittest.TestCase):
+
+    def test_immutable(self):
+        node = InnerTagField(["entity_", VariableField("item")], tag_id="giver", decorators=["upper"])
+        with self.assertRaises(AttributeError):
+            node.tag_id = "taker"
+        with self.assertRaises(AttributeError):
+            node.contents[1].decorators = ["lower"]
+        with self.assertRaises(AttributeError):
+            node.some_attribute = 1
+
+    def test_equality_and_hash(self):
+        self.assertEqual(InnerTagField(["a", VariableField("b")], decorators=["upper"]),
+                         InnerTagField(("a", VariableField("b")), decorators=("upper",)))
+        self.assertNotEqual(VariableField("a"), VariableField("a", decorators=["upper"]))
+        self.assertNotEqual(SwitchField({"m": "em"}, "m", tag_id="gen"), SwitchField({"m": "em"}, "m"))
+        self.assertNotEqual(VariableField("a"), "a")
+
+        nodes = {InnerTagField(["a"]), InnerTagField(["a"]), VariableField("a"), SwitchField([("m", "em")], "m")}
+        self.assertEqual(3, len(nodes))
+        self.assertIn(SwitchField({"m": "em"}, "m"), nodes)
+
+    def test_decorators_are_shared(self):
+        parser = FastParser()
+        first_node, second_node = parser.parse("${a@upper@article}%{b@upper@article}")
+        self.assertIs(first_node.decorators, second_node.decorators)
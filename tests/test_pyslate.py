@@ -1,9 +1,14 @@
 # encoding: utf-8
 import unittest
 import datetime
+import threading
+import time
+from pyslate.backends.json_backend import JsonBackend
+from pyslate.cache import LRUCache, SimpleMemoryCache, BoundedMemoryCache, VersionedCache, RevalidatingCache
 from pyslate.config import DefaultConfig
-from pyslate.parser import PyslateException
-from pyslate.pyslate import Pyslate
+from pyslate.parser import PyslateException, PyParser, CachingParser
+from pyslate.pyslate import Pyslate, _get_single_flight
+from tests.helpers import FakeTimer
 
 
 class Item:
@@ -42,6 +47,33 @@ def obj_fun(helper, name, params):
     return helper.translation("template_obj_fun", quality=quality_tag, item=item_name + ("#" + case if case else "")).strip()
 
 
+class CountingParser(PyParser):
+
+    def __init__(self):
+        super(CountingParser, self).__init__()
+        self.parsed = []
+
+    def parse(self, data, **kwargs):
+        self.parsed.append(data)
+        return super(CountingParser, self).parse(data, **kwargs)
+
+
+class CountingBackend(object):
+
+    def __init__(self):
+        self.backend = BackendStub()
+        self.requested_tags = []
+        self.requested_forms = []
+
+    def get_content(self, tag_names, languages):
+        self.requested_tags.append(tag_names[0])
+        return self.backend.get_content(tag_names, languages)
+
+    def get_form(self, tag_names, languages):
+        self.requested_forms.append(tag_names[0])
+        return self.backend.get_form(tag_names, languages)
+
+
 class BackendStub():
 
     def get_content(self, tag_names, languages):
@@ -376,6 +408,82 @@ class TestTranslationsEnglish(unittest.TestCase):
 
         self.assertEqual(1, calls_count[0])  # make sure that function was called just once
 
+    def test_deterministic_function_with_variant(self):  # memory is shared by all variants, but results are not
+
+        calls_count = [0]
+
+        def fun(helper, tag_name, params):
+            calls_count[0] += 1
+            return tag_name + str(params["count"])
+
+        self.pys.register_function("fun", fun, is_deterministic=True)
+
+        self.assertEqual("fun#p3", self.pys.t("fun#p", count=3))
+        self.assertEqual("fun#p3", self.pys.t("fun#p", count=3))
+        self.assertEqual("fun#w3", self.pys.t("fun#w", count=3))
+        self.assertEqual("fun#p4", self.pys.t("fun#p", count=4))
+
+        self.assertEqual(3, calls_count[0])
+        self.assertEqual(1, self.pys.functions_memory["fun"].hits)
+        self.assertEqual(3, self.pys.functions_memory["fun"].misses)
+
+    def test_deterministic_function_with_unhashable_arguments(self):  # result can't be memorized, but it still works
+
+        calls_count = [0]
+
+        def fun(helper, tag_name, params):
+            calls_count[0] += 1
+            return str(len(params["items"]))
+
+        self.pys.register_function("fun", fun, is_deterministic=True)
+
+        self.assertEqual("2", self.pys.t("fun", items=[Item(1, "sword"), Item(2, "axe")]))
+        self.assertEqual("2", self.pys.t("fun", items=[Item(1, "sword"), Item(2, "axe")]))
+        self.assertEqual(2, calls_count[0])
+        self.assertEqual(0, len(self.pys.functions_memory["fun"]))
+
+    def test_deterministic_function_memory_bounded(self):
+
+        def fun(helper, tag_name, params):
+            return str(params["number"])
+
+        self.pys.register_function("fun", fun, is_deterministic=True, memory_size=2)
+
+        for number in range(5):
+            self.assertEqual(str(number), self.pys.t("fun", number=number))
+        self.assertEqual(2, len(self.pys.functions_memory["fun"]))
+
+    def test_deterministic_decorator(self):
+
+        calls_count = [0]
+
+        def decorator(value):
+            calls_count[0] += 1
+            return value.upper()
+
+        self.pys.register_decorator("shout", decorator, is_deterministic=True)
+
+        self.assertEqual("WELCOME!", self.pys.t("welcome@shout"))
+        self.assertEqual("WELCOME!", self.pys.t("welcome@shout"))
+        self.assertEqual("WELCOME! I HAVE SWORDS.", self.pys.t("item_ownership@shout", item_name="sword"))
+
+        self.assertEqual(2, calls_count[0])
+        self.assertEqual(1, self.pys.functions_memory["shout"].hits)
+
+    def test_non_deterministic_decorator_not_memorized(self):
+
+        calls_count = [0]
+
+        def decorator(value):
+            calls_count[0] += 1
+            return value.upper()
+
+        self.pys.register_decorator("shout", decorator)
+
+        self.assertEqual("WELCOME!", self.pys.t("welcome@shout"))
+        self.assertEqual("WELCOME!", self.pys.t("welcome@shout"))
+        self.assertEqual(2, calls_count[0])
+
     def test_localization(self):  # en = en_GB
         # date
         self.assertEqual("1999-12-15", self.pys.l(datetime.date(1999, 12, 15)))
@@ -409,6 +517,53 @@ class TestTranslationsEnglish(unittest.TestCase):
         self.pys.register_function("fun", fun)
         self.assertEqual("%{name}", self.pys.t("fun", name="John"))
 
+    def test_tag_value_compiled_once(self):  # tag values are parsed only once and then rendered by a cached function
+        parser = CountingParser()
+        self.pys = Pyslate("en", BackendStub(), parser=parser)
+
+        self.assertEqual("Welcome! I have swords.", self.pys.t("item_ownership", item_name="sword"))
+        self.assertEqual("Welcome! I have some stone.", self.pys.t("item_ownership", item_name="stone"))
+        self.assertEqual("Welcome! I have swords.", self.pys.t("item_ownership", item_name="sword"))
+
+        self.assertEqual(1, parser.parsed.count(BackendStub.TAGS["item_ownership"]["en"]))
+        self.assertNotIn(BackendStub.TAGS["welcome"]["en"], parser.parsed)  # plaintext is never parsed
+
+    def test_plaintext_not_parsed(self):
+        parser = CountingParser()
+        self.pys = Pyslate("en", BackendStub(), parser=parser)
+
+        self.assertEqual("Hello world", self.pys.t("hello_world"))
+        self.assertEqual(r"help {me} hehe", self.pys.t("text_with_brackets"))
+        self.assertEqual([], parser.parsed)
+
+    def test_number_of_renderers_limited(self):
+        config = DefaultConfig()
+        config.PARSER_CACHE_SIZE = 0
+        config.RENDERER_CACHE_SIZE = 1
+        parser = CountingParser()
+        self.pys = Pyslate("en", BackendStub(), config=config, parser=parser)
+
+        self.assertEqual("My name is John", self.pys.t("my_name", name="John"))
+        self.assertEqual("Welcome! I have swords.", self.pys.t("item_ownership", item_name="sword"))
+        self.assertEqual("My name is Jan", self.pys.t("my_name", name="Jan"))
+        self.assertEqual(1, len(self.pys._renderers))
+        self.assertEqual(2, parser.parsed.count("My name is %{name}"))  # compiled again after being evicted
+
+    def test_tag_key_needing_parser(self):  # tag keys with special syntax are parsed as if they were inner tags
+        self.assertEqual("A SWORD", self.pys.t("entity_sword@upper"))
+        self.assertEqual("A SWORD", self.pys.t("giver:entity_sword@upper"))
+
+    def test_shared_parser_cache(self):  # the same instance of CachingParser can be used by many Pyslate instances
+        parser = CachingParser(CountingParser())
+        pys_en = Pyslate("en", BackendStub(), parser=parser)
+        pys_pl = Pyslate("pl", BackendStub(), parser=parser)
+        self.assertIs(parser, pys_en.parser)
+
+        self.assertEqual("My name is John", pys_en.t("my_name", name="John"))
+        self.assertEqual("My name is Jan", pys_pl.t("my_name", name="Jan"))
+        self.assertEqual(1, parser.parser.parsed.count("My name is %{name}"))
+
+
 class TestTranslationsPolish(unittest.TestCase):
 
     def setUp(self):
@@ -607,6 +762,358 @@ class TestTranslationsPolish(unittest.TestCase):
         self.assertEqual("3.01.2128, 18:13:22", self.pys.l(datetime.datetime(2128, 1, 3, 18, 13, 22)))
 
 
+class TestLanguageTable(unittest.TestCase):
+
+    def setUp(self):
+        self.pys = Pyslate("pl", backend=BackendStub())
+
+    def test_table_reused(self):
+        self.pys.t("entity_stone", number=3)
+        language_table = self.pys._get_language_table()
+        self.pys.t("hello_world@upper")
+        self.pys.l(1.5)
+        self.assertIs(language_table, self.pys._get_language_table())
+
+    def test_fallbacks_change(self):
+        self.assertEqual(("pl", "en"), self.pys._get_language_table().languages)
+        self.pys.fallbacks["pl"] = "de"
+        self.assertEqual(("pl", "de", "en"), self.pys._get_language_table().languages)
+        self.pys.global_fallback = "pl"
+        self.assertEqual(("pl", "de", "pl"), self.pys._get_language_table().languages)
+
+    def test_language_change(self):
+        self.assertEqual("3 bryły kamieni", self.pys.t("entity_stone", number=3))
+        self.pys.language = "en"
+        self.assertEqual("3 blocks of stone", self.pys.t("entity_stone", number=3))
+        self.assertEqual("1.5", self.pys.l(1.5))
+        self.pys.language = "pl"
+        self.assertEqual("1,5", self.pys.l(1.5))
+
+    def test_registration_after_translation(self):
+        self.assertEqual("Witaj swiecie", self.pys.t("hello_world"))
+        self.pys.register_decorator("shout", lambda value: value.upper() + "!", language="pl")
+        self.pys.register_function("hello_world", lambda helper, name, params: "Hej")
+
+        self.assertEqual("HEJ!", self.pys.t("hello_world@shout"))
+        self.pys.language = "en"
+        self.assertRaises(PyslateException, self.pys.t, "hello_world@shout")
+
+    def test_locales_replaced(self):
+        self.assertEqual("1,5", self.pys.l(1.5))
+        self.pys.locales = dict(self.pys.locales, pl=self.pys.locales["en"])
+        self.assertEqual("1.5", self.pys.l(1.5))
+
+
+class RecordBackend(object):
+    """Backend implementing only get_record method"""
+
+    def __init__(self):
+        self.backend = BackendStub()
+        self.requested_tags = []
+
+    def get_record(self, tag_names, languages):
+        self.requested_tags.append(list(tag_names))
+        content = self.backend.get_content(tag_names, languages)
+        if content is None:
+            return None
+        return content, self.backend.get_form(tag_names, languages)
+
+
+class TestRecordBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = RecordBackend()
+        self.pys = Pyslate("pl", self.backend)
+        self.pys.fallbacks["pl"] = "en"
+
+    def test_single_call_per_tag(self):
+        self.assertEqual("łosia", self.pys.t("entity_elk#ab"))
+        self.assertEqual(("różdżka", "f"), self.pys._translate("entity_wand"))
+        self.assertEqual([["entity_elk#ab", "entity_elk#a", "entity_elk"], ["entity_wand"]],
+                         self.backend.requested_tags)
+
+    def test_missing_tag(self):
+        self.assertEqual("[MISSING TAG 'missing#p']", self.pys.t("missing#p"))
+
+    def test_missing_tag_output_not_compiled(self):
+        self.pys.on_missing_tag_key_callback = lambda name, params: "%{" + name + "}"
+
+        self.assertEqual("%{missing}", self.pys.t("missing"))
+        self.assertEqual(0, len(self.pys._renderers))
+
+
+class TestContentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = CountingBackend()
+        self.pys = Pyslate("pl", self.backend, cache=SimpleMemoryCache())
+        self.pys.fallbacks["pl"] = "en"
+
+    def test_content_and_form_cached(self):
+        def fun_tajnosc(helper, name, params):
+            helper.return_form(helper.form("entity_" + params["item_name"]))
+            return helper.translation("tajnosc", **params)
+
+        self.pys.register_function("fun_tajnosc", fun_tajnosc)
+        for i in range(2):
+            self.assertEqual("Zniszczono nowy wałek. Jest fajny.", self.pys.t("char_victim2", item_name="doughroller"))
+        self.assertEqual(["char_victim2", "entity_doughroller", "tajnosc"], self.backend.requested_tags)
+        self.assertEqual(["char_victim2", "entity_doughroller", "tajnosc"], self.backend.requested_forms)
+        self.assertEqual(("wałek", "m"), self.pys.cache.load("entity_doughroller", "pl"))
+
+    def test_cached_with_fallbacks(self):
+        for i in range(2):
+            self.assertEqual("Welcome!", self.pys.t("welcome"))
+            self.assertEqual("łosia", self.pys.t("entity_elk#ab"))
+        self.assertEqual(["welcome", "entity_elk#ab"], self.backend.requested_tags)
+        self.assertEqual(("Welcome!", None), self.pys.cache.load("welcome", "pl"))
+
+    def test_missing_cached(self):
+        config = DefaultConfig()
+        config.CACHE_MISSING_TAGS = True
+        self.pys = Pyslate("pl", self.backend, config=config, cache=BoundedMemoryCache(missing_ttl=60))
+        missing_tags = []
+        self.pys.on_missing_tag_key_callback = lambda name, params: missing_tags.append(name) or "[MISSING]"
+
+        for i in range(2):
+            self.assertEqual("lala [MISSING]", self.pys.t("missing_tag"))
+            self.assertEqual("[MISSING]", self.pys.t("entity_unknown#p"))
+        self.assertEqual(["missing_tag", "hehe", "entity_unknown#p"], self.backend.requested_tags)
+        self.assertEqual(["hehe", "entity_unknown#p"] * 2, missing_tags)  # callback is run every time
+        self.assertEqual((None, None), self.pys.cache.load("hehe", "pl"))
+
+    def test_stale_content_refreshed(self):
+        timer = FakeTimer()
+        refreshes = []
+        executor = type("Executor", (object,), {"submit": lambda self, function: refreshes.append(function)})()
+        self.pys.cache = RevalidatingCache(SimpleMemoryCache(), soft_ttl=10, executor=executor, timer=timer)
+        self.assertEqual("Welcome!", self.pys.t("welcome"))
+
+        timer.now += 20
+        self.assertEqual("Welcome!", self.pys.t("welcome"))
+        self.assertEqual(["welcome"], self.backend.requested_tags)
+
+        refreshes[0]()
+        self.assertEqual(["welcome", "welcome"], self.backend.requested_tags)
+        self.assertEqual("Welcome!", self.pys.t("welcome"))
+        self.assertEqual(1, self.pys.cache.refreshes)
+
+    def test_missing_not_cached_by_default(self):
+        self.assertEqual("lala [MISSING TAG 'hehe']", self.pys.t("missing_tag"))
+        self.assertIsNone(self.pys.cache.load("hehe", "pl"))
+
+
+class TestPreload(unittest.TestCase):
+
+    def setUp(self):
+        json_data = {}
+        for tag_name, translations in BackendStub.TAGS.items():
+            forms = translations.get("form", {})
+            json_data[tag_name] = dict((language, [content, forms[language]] if language in forms else content)
+                                       for language, content in translations.items() if language != "form")
+        self.backend = JsonBackend(json_data=json_data)
+        self.pys = Pyslate("pl", self.backend, cache=SimpleMemoryCache())
+        self.pys.fallbacks["pl"] = "en"
+
+    def test_same_records_as_loaded_lazily(self):
+        preloaded_count = self.pys.preload(["pl", "en"])
+
+        lazy_pyslate = Pyslate("pl", self.backend)
+        lazy_pyslate.fallbacks["pl"] = "en"
+        found_count = 0
+        for language in ["pl", "en"]:
+            self.pys.language = lazy_pyslate.language = language
+            for tag_name in BackendStub.TAGS:
+                record = lazy_pyslate._get_raw_record(tag_name)
+                if record[0] is not None:
+                    found_count += 1
+                    self.assertEqual(record, self.pys.cache.load(tag_name, language))
+                else:
+                    self.assertIsNone(self.pys.cache.load(tag_name, language))
+        self.assertEqual(found_count, preloaded_count)
+
+    def test_no_backend_calls_after_preload(self):
+        self.pys.preload()
+        self.pys.backend = None
+
+        self.assertEqual("Witaj swiecie", self.pys.t("hello_world"))
+        self.assertEqual("Welcome!", self.pys.t("welcome"))
+        self.assertEqual("różdżka", self.pys.t("entity_wand"))
+        self.assertIsNone(self.pys.cache.load("hello_world", "en"))
+
+    def test_prefix(self):
+        self.pys.preload(prefix="entity_")
+
+        self.assertEqual(("miecz", None), self.pys.cache.load("entity_sword", "pl"))
+        self.assertIsNone(self.pys.cache.load("hello_world", "pl"))
+
+    def test_without_cache(self):
+        self.pys.cache = None
+        self.assertEqual(0, self.pys.preload())
+
+
+class TestCoalescedBackendCalls(unittest.TestCase):
+
+    def test_concurrent_misses_coalesced(self):
+        backend = CountingBackend()
+        release = threading.Event()
+        get_content = backend.get_content
+
+        def blocking_get_content(tag_names, languages):
+            release.wait(5)
+            return get_content(tag_names, languages)
+
+        backend.get_content = blocking_get_content
+        results = []
+
+        def translate():
+            pyslate = Pyslate("en", backend, cache=SimpleMemoryCache())
+            results.append(pyslate.t("hello_world"))
+
+        threads = [threading.Thread(target=translate) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        single_flight = _get_single_flight(backend)
+        deadline = time.time() + 5
+        while single_flight.coalesced < 4:
+            if time.time() > deadline:
+                release.set()  # waiting threads are let go, so they don't hang
+                self.fail("calls were not coalesced in time")
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(["Hello world"] * 5, results)
+        self.assertEqual(["hello_world"], backend.requested_tags)
+
+    def test_saved_before_call_finished(self):  # so threads coming later find the record in the cache
+        backend = CountingBackend()
+        single_flight = _get_single_flight(backend)
+        cache = SimpleMemoryCache()
+        save = cache.save
+        calls_in_flight = []
+
+        def checking_save(*args):
+            calls_in_flight.append(len(single_flight._calls))
+            save(*args)
+
+        cache.save = checking_save
+        self.assertEqual("Hello world", Pyslate("en", backend, cache=cache).t("hello_world"))
+        self.assertEqual([1], calls_in_flight)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = CountingBackend()
+        self.pys = Pyslate("pl", self.backend, result_cache=LRUCache())
+        self.pys.fallbacks["pl"] = "en"
+
+    def test_cached_result(self):
+        self.assertEqual("10 marchewek", self.pys.t("entity_carrot", number=10))
+        self.assertEqual("10 marchewek", self.pys.t("entity_carrot", number=10))
+        self.assertEqual("4 marchewki", self.pys.t("entity_carrot", number=4))
+        self.assertEqual("Miecz", self.pys.t("entity_sword@capitalize"))
+        self.assertEqual("Miecz", self.pys.t("entity_sword@capitalize"))
+
+        self.assertEqual(2, self.pys.result_cache.hits)
+        self.assertEqual(3, len(self.backend.requested_tags))
+
+    def test_key_contains_all_arguments(self):
+        self.pys.context = {"me": "f"}
+        self.assertEqual("Powiedziałam mu, że to głupie, a on powiedział mi to samo.",
+                         self.pys.t("talking_the_same", sb="m"))
+        self.assertEqual("Powiedziałam jej, że to głupie, a ona powiedziała mi to samo.",
+                         self.pys.t("talking_the_same", sb="f"))
+        self.pys.context = {"me": "m"}
+        self.assertEqual("Powiedziałem mu, że to głupie, a on powiedział mi to samo.",
+                         self.pys.t("talking_the_same", sb="m"))
+
+        self.pys.language = "en"
+        self.assertEqual("I told him it's stupid and he told me the same.", self.pys.t("talking_the_same", sb="m"))
+
+    def test_invalidated_with_cache(self):
+        for wrap in [lambda cache: cache, lambda cache: RevalidatingCache(cache)]:
+            timer = FakeTimer()
+            backend = JsonBackend(json_data={"hello": {"pl": "Witaj"}})
+            backend.get_version = lambda: version[0]
+            version = [1]
+            self.pys = Pyslate("pl", backend, cache=wrap(VersionedCache(SimpleMemoryCache(), backend, timer=timer)),
+                               result_cache=LRUCache())
+            self.assertEqual("Witaj", self.pys.t("hello"))
+
+            backend.tags["hello"]["pl"] = "Cześć"
+            version[0] = 2
+            self.assertEqual("Witaj", self.pys.t("hello"))
+            timer.now += 5
+            self.assertEqual("Cześć", self.pys.t("hello"))
+
+    def test_groups_are_cached(self):
+        self.pys.register_function("char_info", lambda helper, name, params: "John" if params['char_id'] == 1 else "Edd",
+                                   is_deterministic=True)
+        groups = {"giver": {"char_id": 1}, "taker": {"char_id": 2}}
+        self.pys.t("action_give_others", item_name="carrot", groups=groups)
+        self.assertEqual("You see John give trochę marchewek to Edd.",
+                         self.pys.t("action_give_others", item_name="carrot", groups=groups))
+        self.assertEqual(1, self.pys.result_cache.hits)
+
+        groups["giver"]["char_id"] = 2
+        self.assertEqual("You see Edd give trochę marchewek to Edd.",
+                         self.pys.t("action_give_others", item_name="carrot", groups=groups))
+
+    def test_not_cached(self):
+        self.pys.register_function("object_info", obj_fun)  # non-deterministic function
+        for i in range(2):
+            self.assertEqual("wspaniale wykonany młotek",
+                             self.pys.t("object_info", item=Item(1, "hammer", quality=10), item_name="hammer"))
+            self.assertEqual("młotek", self.pys.t("object_info", item=None, item_name="hammer"))
+            self.assertEqual("lala [MISSING TAG 'hehe']", self.pys.t("missing_tag"))
+        self.assertEqual(0, len(self.pys.result_cache))
+
+    def test_results_of_instances_not_mixed(self):
+        result_cache = LRUCache()
+        first_pyslate = Pyslate("en", JsonBackend(json_data={"x": {"en": "one"}}), result_cache=result_cache)
+        second_pyslate = Pyslate("en", JsonBackend(json_data={"x": {"en": "two"}}), result_cache=result_cache)
+
+        self.assertEqual("one", first_pyslate.t("x"))
+        self.assertEqual("two", second_pyslate.t("x"))
+
+    def test_decorator_from_config_not_memorized(self):
+        calls = []
+
+        def count(value):
+            calls.append(value)
+            return value + str(len(calls))
+
+        config = DefaultConfig()
+        config.GLOBAL_DECORATORS = dict(config.GLOBAL_DECORATORS, count=count)
+        self.pys = Pyslate("pl", self.backend, config=config, result_cache=LRUCache())
+        self.assertEqual("miecz1", self.pys.t("entity_sword@count"))
+        self.assertEqual("miecz2", self.pys.t("entity_sword@count"))
+        self.assertEqual("MIECZ", self.pys.t("entity_sword@upper"))
+        self.assertEqual("MIECZ", self.pys.t("entity_sword@upper"))
+        self.assertEqual(1, self.pys.result_cache.hits)
+
+    def test_non_deterministic_decorator_not_cached(self):
+        calls = []
+
+        def count(value):
+            calls.append(value)
+            return value + str(len(calls))
+
+        self.pys.register_decorator("count", count)
+        self.assertEqual("miecz1", self.pys.t("entity_sword@count"))
+        self.assertEqual("miecz2", self.pys.t("entity_sword@count"))
+        self.assertEqual(0, len(self.pys.result_cache))
+
+    def test_registration_changes_result(self):
+        self.pys.register_decorator("shout", lambda value: value.upper())
+        self.assertEqual("MIECZ", self.pys.t("entity_sword@shout"))
+        self.pys.register_decorator("shout", lambda value: value + "!")
+        self.assertEqual("miecz!", self.pys.t("entity_sword@shout"))
+
+
 class TestConfigPolishTranslations(unittest.TestCase):
 
     def test_no_inner_tags(self):